@@ -0,0 +1,358 @@
+""" Model of MicroPython heap allocations, for running the allocation test
+under CPython.
+
+CPython has no gc.mem_alloc() and allocates for nearly everything, so
+instead the driver's modules (those under src/) are imported with their
+code instrumented to count the operations that allocate under MicroPython:
+
+    float boxes     every new float: arithmetic with a float result, loads
+                    from float arrays, floats returned by builtins such as
+                    math.sqrt(). Float constants do not allocate.
+    other           any other new object: tuple, list, dict and set displays
+                    (but not constant tuples or the 2 and 3 element swaps the
+                    compiler turns into stack operations), slices,
+                    comprehensions, lambdas and nested functions, f-strings,
+                    bound methods that are stored rather than called, star
+                    calls, instances, generators, and containers returned by
+                    builtins. Loops over range() do not allocate.
+
+Integers outside the small int range are counted as float boxes too (one
+block each). Slices that are assigned to (a[:] = b) are not counted: since
+MicroPython 1.23 a slice used to subscript a built-in type is built on the
+stack. Code outside of src/, such as the simulated camera and the CPython
+shims, is not counted.
+
+    install()
+    import mlx90640 ...
+    COUNTS.reset()
+    COUNTS.enabled = True
+    ...
+    COUNTS.enabled = False
+    COUNTS.boxes, COUNTS.other, COUNTS.sites
+"""
+
+import ast
+import os
+import sys
+import types
+from array import array
+
+_SRC = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'src')) + os.sep
+
+_SMALL_INT = 1 << 30
+_FLOAT_TYPECODES = ('f', 'd')
+
+class Counts:
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.boxes = 0
+        self.other = 0
+        self.sites = {}  # { (file, line, kind) : count } of the other allocations
+
+    def box(self, value):
+        if self.enabled and _is_box(value):
+            self.boxes += 1
+        return value
+
+    def new(self, site, kind, count=1):
+        if self.enabled:
+            self.other += count
+            key = (site[0], site[1], kind)
+            self.sites[key] = self.sites.get(key, 0) + count
+
+COUNTS = Counts()
+
+def _is_box(value):
+    if isinstance(value, float):
+        return True
+    return type(value) is int and not -_SMALL_INT <= value < _SMALL_INT
+
+
+## Runtime helpers called by the instrumented code
+
+def _value(site, value):
+    # result of an operator, a new object unless it is a small int, bool or None
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return COUNTS.box(value)
+    COUNTS.new(site, type(value).__name__)
+    return value
+
+def _item(site, container, index):
+    if isinstance(index, slice):
+        COUNTS.new(site, 'slice')
+    value = container[index]
+    if isinstance(index, slice):
+        COUNTS.new(site, type(value).__name__)
+    elif _is_float_buffer(container):
+        COUNTS.box(value)
+    return value
+
+def _is_float_buffer(container):
+    if isinstance(container, array):
+        return container.typecode in _FLOAT_TYPECODES
+    if isinstance(container, memoryview):
+        return container.format in _FLOAT_TYPECODES
+    return False
+
+def _attr(site, value):
+    # an attribute loaded other than to call it
+    if isinstance(value, types.MethodType) or (
+            isinstance(value, types.BuiltinMethodType)
+            and not isinstance(getattr(value, '__self__', None), (types.ModuleType, type(None)))):
+        COUNTS.new(site, 'bound method')
+    return value
+
+def _fresh(value):
+    # True if value was just created, nothing but the caller refers to it
+    return sys.getrefcount(value) <= _FRESH_REFS
+
+def _func(site, func):
+    # wraps builtins so that their results are counted
+    if func is super:
+        return func
+    if isinstance(func, types.MethodType):
+        target = func.__func__
+    else:
+        target = func
+    if isinstance(target, types.FunctionType):
+        if target.__code__.co_flags & 0x20:  # generator
+            COUNTS.new(site, 'generator')
+        return func
+    if isinstance(func, type):
+        if issubclass(func, BaseException):
+            return func
+    name = getattr(func, '__name__', 'call')
+    def call(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if func is abs:
+            # a new float only for negative arguments
+            if args[0] < 0:
+                COUNTS.box(result)
+        elif _fresh(result):
+            _result(site, result, name)
+        return result
+    return call
+
+def _result(site, value, name):
+    if value is None or isinstance(value, bool):
+        return
+    if isinstance(value, (int, float)):
+        COUNTS.box(value)
+    else:
+        COUNTS.new(site, f"{name}() -> {type(value).__name__}")
+
+def _measure_fresh_refs():
+    # the reference count _fresh() sees for a new object, held as in call()
+    def probe(value):
+        return sys.getrefcount(value)
+    result = float(len(sys.argv) + 0.5)
+    return probe(result)
+
+_FRESH_REFS = _measure_fresh_refs()
+
+def _aug(site, value):
+    # the result of an augmented assignment, loaded back from its target
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        COUNTS.box(value)
+    return value
+
+
+## Instrumentation
+
+class _Instrument(ast.NodeTransformer):
+    def __init__(self, filename):
+        self.filename = filename
+        self.depth = 0  # of nested function definitions
+
+    def _site(self, node):
+        return ast.Tuple([ast.Constant(self.filename), ast.Constant(node.lineno)], ast.Load())
+
+    def _helper(self, name, node, *args):
+        call = ast.Call(ast.Name(name, ast.Load()), [self._site(node), *args], [])
+        return ast.copy_location(call, node)
+
+    def _new(self, node, kind):
+        # counts an allocation and evaluates node
+        return ast.copy_location(ast.Subscript(
+            ast.Tuple([self._helper('__alloc_new__', node, ast.Constant(kind)), node], ast.Load()),
+            ast.Constant(1), ast.Load()), node)
+
+    def _body(self, stmts):
+        body = []
+        for stmt in stmts:
+            stmt = self.visit(stmt)
+            body.extend(stmt if isinstance(stmt, list) else (stmt,))
+        return body
+
+    def visit_FunctionDef(self, node):
+        self.depth += 1
+        node.body = self._body(node.body)
+        node.args = self.visit(node.args)
+        self.depth -= 1
+        # only the defaults and decorators are evaluated where it is defined
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        if self.depth > 0:
+            count = ast.Expr(self._helper('__alloc_new__', node, ast.Constant('function')))
+            return [ast.copy_location(count, node), node]
+        return node
+
+    def visit_Lambda(self, node):
+        self.generic_visit(node)
+        return self._new(node, 'lambda')
+
+    def visit_ClassDef(self, node):
+        self.generic_visit(node)
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        return self._helper('__alloc_value__', node, node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return node
+        return self._helper('__alloc_value__', node, node)
+
+    def visit_AugAssign(self, node):
+        self.generic_visit(node)
+        target = _as_load(node.target)
+        check = ast.Expr(self._helper('__alloc_aug__', node, target))
+        return [node, ast.copy_location(check, node)]
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        index = node.slice
+        if isinstance(index, ast.Slice):
+            index = ast.Call(ast.Name('slice', ast.Load()),
+                             [index.lower or ast.Constant(None), index.upper or ast.Constant(None),
+                              index.step or ast.Constant(None)], [])
+        return self._helper('__alloc_item__', node, node.value, index)
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load) or getattr(node, '_called', False):
+            return node
+        return self._helper('__alloc_attr__', node, node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            node.func._called = True
+        self.generic_visit(node)
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(kw.arg is None for kw in node.keywords):
+            node = self._new(node, 'star call')
+            call = node.elts[1] if isinstance(node, ast.Tuple) else node.value.elts[1]
+        else:
+            call = node
+        call.func = self._helper('__alloc_func__', call, call.func)
+        return node
+
+    def visit_For(self, node):
+        # for ... in range(...) is compiled to a counter loop
+        if (isinstance(node.iter, ast.Call) and isinstance(node.iter.func, ast.Name)
+                and node.iter.func.id == 'range'):
+            node.iter.args = [self.visit(arg) for arg in node.iter.args]
+            node.target = self.visit(node.target)
+            node.body = self._body(node.body)
+            node.orelse = self._body(node.orelse)
+            return node
+        self.generic_visit(node)
+        return node
+
+    def visit_Assign(self, node):
+        # a, b = c, d is done on the stack
+        if (len(node.targets) == 1 and isinstance(node.targets[0], ast.Tuple)
+                and isinstance(node.value, ast.Tuple)
+                and len(node.value.elts) == len(node.targets[0].elts) <= 3):
+            node.value.elts = [self.visit(elt) for elt in node.value.elts]
+            node.targets = [self.visit(target) for target in node.targets]
+            return node
+        self.generic_visit(node)
+        return node
+
+    def _display(self, node, kind):
+        self.generic_visit(node)
+        if not isinstance(getattr(node, 'ctx', ast.Load()), ast.Load):
+            return node
+        if kind == 'tuple' and all(isinstance(elt, ast.Constant) for elt in node.elts):
+            return node  # a constant
+        return self._new(node, kind)
+
+    def visit_Tuple(self, node):
+        return self._display(node, 'tuple')
+
+    def visit_List(self, node):
+        return self._display(node, 'list')
+
+    def visit_Dict(self, node):
+        return self._display(node, 'dict')
+
+    def visit_Set(self, node):
+        return self._display(node, 'set')
+
+    def visit_JoinedStr(self, node):
+        return self._new(node, 'str')
+
+    def _comprehension(self, node):
+        self.generic_visit(node)
+        return self._new(node, type(node).__name__)
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _comprehension
+
+def _as_load(target):
+    target = ast.parse(ast.unparse(target), mode='eval').body
+    return target
+
+_HELPERS = {
+    '__alloc_value__': _value,
+    '__alloc_item__': _item,
+    '__alloc_attr__': _attr,
+    '__alloc_func__': _func,
+    '__alloc_aug__': _aug,
+    '__alloc_new__': lambda site, kind: COUNTS.new(site, kind),
+}
+
+
+class _Loader:
+    def __init__(self, spec_loader, path):
+        self.spec_loader = spec_loader
+        self.path = path
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        with open(self.path) as src:
+            tree = ast.parse(src.read(), self.path)
+        name = self.path[len(_SRC):]
+        tree = ast.fix_missing_locations(_Instrument(name).visit(tree))
+        module.__dict__.update(_HELPERS)
+        exec(compile(tree, self.path, 'exec'), module.__dict__)
+
+class _Finder:
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        origin = os.path.realpath(spec.origin or '')
+        if origin.endswith('.py') and origin.startswith(_SRC):
+            spec.loader = _Loader(spec.loader, origin)
+        return spec
+
+def install():
+    # modules from src/ imported after this are instrumented
+    if not any(isinstance(finder, _Finder) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _Finder())
+    return COUNTS
@@ -0,0 +1,35 @@
+""" MicroPython builtins for running the driver under CPython.
+
+Importing this module adds const() to the builtins and the ticks functions
+to the time module. The u-prefixed modules are provided by the other files
+in this directory, which should be on sys.path.
+"""
+
+import builtins
+import time
+
+def const(value):
+    return value
+
+_TICKS_PERIOD = 1 << 30
+
+def ticks_us():
+    return (time.perf_counter_ns()//1000) % _TICKS_PERIOD
+
+def ticks_ms():
+    return (time.perf_counter_ns()//1000000) % _TICKS_PERIOD
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % _TICKS_PERIOD
+
+def ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) % _TICKS_PERIOD
+    if diff >= _TICKS_PERIOD//2:
+        diff -= _TICKS_PERIOD
+    return diff
+
+builtins.const = const
+time.ticks_us = ticks_us
+time.ticks_ms = ticks_ms
+time.ticks_add = ticks_add
+time.ticks_diff = ticks_diff
@@ -0,0 +1,87 @@
+""" The subset of uctypes used by utils: big-endian scalar fields, 16 bit
+bitfields and word arrays at offset 0.
+
+CPython has no addressof() that struct() could map back to memory, so
+addressof() returns the buffer itself. This is much slower than the real
+module, so timings of code that decodes Structs are not comparable.
+"""
+
+UINT8    = 1 << 27
+INT8     = 2 << 27
+UINT16   = 3 << 27
+INT16    = 4 << 27
+BFUINT16 = 5 << 27
+ARRAY    = 6 << 27
+_TYPE_MASK = 7 << 27
+
+BF_POS = 17
+BF_LEN = 22
+_OFFSET_MASK = (1 << BF_POS) - 1
+
+LITTLE_ENDIAN = 0
+BIG_ENDIAN = 1
+NATIVE = 2
+
+def addressof(buf):
+    return buf
+
+def struct(addr, layout, layout_type=NATIVE):
+    if layout_type != BIG_ENDIAN:
+        raise ValueError("only BIG_ENDIAN layouts are supported")
+    return _Struct(addr, layout)
+
+def _bitfield(desc):
+    pos = (desc >> BF_POS) & 0x1F
+    length = (desc >> BF_LEN) & 0x1F
+    return pos, ((1 << length) - 1) << pos
+
+class _WordArray:
+    def __init__(self, buf, signed, count):
+        self._buf = memoryview(buf).cast('B')
+        self._signed = signed
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        return int.from_bytes(self._buf[2*idx:2*idx + 2], 'big', signed=self._signed)
+
+    def __setitem__(self, idx, value):
+        self._buf[2*idx:2*idx + 2] = (value & 0xFFFF).to_bytes(2, 'big')
+
+class _Struct:
+    def __init__(self, buf, layout):
+        object.__setattr__(self, '_buf', memoryview(buf).cast('B'))
+        object.__setattr__(self, '_layout', layout)
+
+    def __getattr__(self, name):
+        desc = self._layout[name]
+        buf = self._buf
+        if isinstance(desc, tuple):
+            elem = desc[1]
+            return _WordArray(buf, elem & _TYPE_MASK == INT16, elem & _OFFSET_MASK)
+
+        kind = desc & _TYPE_MASK
+        offset = desc & _OFFSET_MASK
+        if kind in (UINT8, INT8):
+            return int.from_bytes(buf[offset:offset + 1], 'big', signed=kind == INT8)
+        word = int.from_bytes(buf[offset:offset + 2], 'big', signed=kind == INT16)
+        if kind == BFUINT16:
+            pos, mask = _bitfield(desc)
+            return (word & mask) >> pos
+        return word
+
+    def __setattr__(self, name, value):
+        desc = self._layout[name]
+        buf = self._buf
+        kind = desc & _TYPE_MASK
+        offset = desc & _OFFSET_MASK
+        if kind in (UINT8, INT8):
+            buf[offset] = value & 0xFF
+            return
+        if kind == BFUINT16:
+            pos, mask = _bitfield(desc)
+            word = int.from_bytes(buf[offset:offset + 2], 'big')
+            value = (word & ~mask) | ((value << pos) & mask)
+        buf[offset:offset + 2] = (value & 0xFFFF).to_bytes(2, 'big')
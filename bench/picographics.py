@@ -0,0 +1,59 @@
+""" Stand-in for the PicoGraphics module, for running the display code
+without a display. Drawing calls are counted and otherwise ignored.
+"""
+
+DISPLAY_PICO_DISPLAY = 0
+PEN_RGB332 = 0
+
+_BOUNDS = {
+    DISPLAY_PICO_DISPLAY : (240, 135),
+}
+
+class PicoGraphics:
+    def __init__(self, display=DISPLAY_PICO_DISPLAY, pen_type=PEN_RGB332, **kwargs):
+        self.bounds = _BOUNDS[display]
+        self.pen = 0
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.pens_set = 0
+        self.shapes = 0  # rectangles, lines and pixels
+        self.pixels = 0  # pixels covered by spans and rectangles
+        self.updates = 0
+
+    def get_bounds(self):
+        return self.bounds
+
+    def create_pen(self, r, g, b):
+        return (r & 0xE0) | ((g & 0xE0) >> 3) | ((b & 0xC0) >> 6)
+
+    def set_pen(self, pen):
+        self.pen = pen
+        self.pens_set += 1
+
+    def set_font(self, font):
+        pass
+
+    def clear(self):
+        self.shapes += 1
+
+    def rectangle(self, x, y, w, h):
+        self.shapes += 1
+        self.pixels += w*h
+
+    def pixel(self, x, y):
+        self.shapes += 1
+        self.pixels += 1
+
+    def pixel_span(self, x, y, length):
+        self.shapes += 1
+        self.pixels += length
+
+    def line(self, x1, y1, x2, y2):
+        self.shapes += 1
+
+    def text(self, text, x, y, wordwrap=None, scale=None, **kwargs):
+        self.shapes += 1
+
+    def update(self):
+        self.updates += 1
@@ -0,0 +1,405 @@
+""" Per-stage benchmark of the acquisition -> compensation -> render pipeline.
+
+Runs each stage on its own and then the whole frame loop end to end, against
+a simulated camera (sim.py) and a stand-in display (picographics.py), both in
+this directory. Works under CPython and the MicroPython Unix port:
+
+    micropython bench/pipeline.py [options]
+    python3 bench/pipeline.py [options]
+
+Options:
+    --frames N          frames per stage and for the end to end run (default 64)
+    --calib-runs N      calibration builds to time (default 3)
+    --output PATH       write the JSON results to PATH instead of stdout
+    --baseline PATH     compare against an earlier result, exit 1 on regressions
+    --tolerance X       allowed slowdown/extra allocation as a fraction (default 0.25)
+    --max-frame-alloc N exit 1 if acquisition and compensation of a subpage
+                        allocates more than N bytes (MicroPython only)
+
+Every compensation backend is also run over the same simulated subpages of
+both readout patterns and compared with the reference kernel, the run exits 1
+if any of them differs by more than its KERNEL_TOLERANCE.
+
+Allocations are measured with gc.mem_alloc() under MicroPython (bytes per
+run, with the GC held off). CPython has no equivalent, so the net change in
+allocated blocks is reported instead and is not compared to a baseline.
+Under CPython uctypes is emulated in Python, so stages that decode register
+and EEPROM structs are much slower than they would otherwise be.
+"""
+
+import sys
+import gc
+import json
+
+_IS_MICROPYTHON = sys.implementation.name == 'micropython'
+
+def _setup_path():
+    here = __file__.rpartition('/')[0] or '.'
+    sys.path.insert(0, here + '/../src')
+    sys.path.insert(0, here)
+    if not _IS_MICROPYTHON:
+        sys.path.insert(0, here + '/cpython')
+        import mpcompat
+
+_setup_path()
+
+import time
+from array import array
+
+import mlx90640
+from sim import SimulatedI2C, ManualClock
+from mlx90640.calibration import CameraCalibration, NUM_ROWS, NUM_COLS, IMAGE_SIZE
+from mlx90640.image import (
+    ChessPattern,
+    InterleavedPattern,
+    RawImage,
+    ProcessedImage,
+    InterpolationPlan,
+    get_subpage,
+    merge_bad_pixels,
+)
+from mlx90640.compensation import KERNELS
+from mlx90640.temporal import TemporalFilter, FILTER_EMA, FILTER_BOX
+
+from frames import FrameRing
+from display import DISPLAY, Rect, PixMap
+from display.gradient import WhiteHot
+
+DEFAULT_TOLERANCE = 0.25
+_ALLOC_SLACK = const(64)  # bytes of allocation noise ignored in comparisons
+
+# bad pixels as configured on the device
+_BAD_PIXELS = (30, 31, 63, 127, 191, 481, 482, 483, 703, 735, 767)
+
+# largest difference from the reference kernel allowed per backend, as
+# (v_ir, alpha and buf relative to the largest magnitude in each, temperature
+# maps in degC). fused does the same float operations in the same order as
+# the reference and has to match it exactly, the array backend computes in
+# float32 throughout
+KERNEL_TOLERANCE = {
+    'fused': (0.0, 0.0),
+    'array': (1e-6, 1e-4),
+}
+_DEFAULT_KERNEL_TOLERANCE = (1e-5, 1e-3)
+_KERNEL_CHECK_SUBPAGES = const(8)  # per readout pattern
+
+
+if _IS_MICROPYTHON:
+    ALLOC_UNIT = 'bytes'
+    def _mem_alloc():
+        return gc.mem_alloc()
+else:
+    ALLOC_UNIT = 'blocks'
+    def _mem_alloc():
+        return sys.getallocatedblocks()
+
+def measure(func, runs, setup=None):
+    # times runs calls of func, setup is called before each one untimed
+    times = []
+    alloc = 0
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        times.append(0)
+        gc.collect()
+        gc.disable()
+        start_alloc = _mem_alloc()
+        start = time.ticks_us()
+        func()
+        end = time.ticks_us()
+        alloc += _mem_alloc() - start_alloc
+        gc.enable()
+        times[-1] = time.ticks_diff(end, start)
+
+    times.sort()
+    return {
+        'runs': runs,
+        'mean_us': sum(times)//runs,
+        'median_us': times[runs//2],
+        'min_us': times[0],
+        'max_us': times[-1],
+        'alloc': alloc//runs,
+    }
+
+
+class Pipeline:
+    # the device's frame loop, minus the asyncio scheduling
+    def __init__(self, refresh_rate=8):
+        self.clock = ManualClock()
+        self.bus = SimulatedI2C(clock=self.clock)
+        self.camera = mlx90640.detect_camera(self.bus)
+        self.camera.configure(pattern=ChessPattern, refresh_rate=refresh_rate,
+                              subpage_mode=mlx90640.SUBPAGE_ALTERNATE)
+        self.period_us = int(1000000/self.camera.refresh_rate)
+
+        self.camera.setup(calib_cache=None)
+        self.calib = self.camera.calib
+        self.image = self.camera.image
+        self.bad_pix = merge_bad_pixels(self.calib, _BAD_PIXELS)
+        self.interp_plan = InterpolationPlan(self.bad_pix)
+        self.image.set_exclusions(self.bad_pix)
+
+        self.frames = FrameRing(IMAGE_SIZE)
+        self.pixmap = PixMap(NUM_ROWS, NUM_COLS, self.frames.back.buf)
+        self.pixmap.update_rect(Rect(0, 0, *DISPLAY.get_bounds()))
+        self.gradient = WhiteHot()
+        self.temps = array('f', (0.0 for i in range(IMAGE_SIZE)))
+        self.pens = bytearray(IMAGE_SIZE)
+
+        self.sp_id = 0
+        self.state = mlx90640.CameraState()
+        self.step()  # fill both subpages
+        self.step()
+
+    def next_subpage(self):
+        # lets the sensor measure another subpage
+        self.clock.advance(self.period_us)
+        self.sp_id = self.camera.read_status()['last_subpage']
+
+    def process(self):
+        # acquisition and compensation of the next subpage
+        self.clock.advance(self.period_us)
+        self.process_ready()
+
+    def process_ready(self):
+        # acquisition and compensation of a subpage the sensor has already measured
+        camera = self.camera
+        status = camera.read_status()
+        sp_id = status['last_subpage']
+        camera.read_image(sp_id, status=status)
+        state = camera.read_state(out=self.state)
+        image = camera.process_image(sp_id, state)
+        image.interpolate_bad_pixels(self.interp_plan)
+        self.frames.publish(image, state)
+
+    def show(self):
+        # hand the latest frame to the pixmap
+        frame = self.frames.acquire()
+        self.pixmap.buf = frame.buf
+        self.gradient.h_scale = (frame.limits.min_h, frame.limits.max_h)
+
+    def render(self):
+        self.pixmap.draw_map(DISPLAY, self.gradient)
+        DISPLAY.update()
+
+    def step(self):
+        self.process()
+        self.show()
+        self.render()
+
+    def next_frame(self):
+        self.process()
+        self.show()
+
+
+def _max_difference(expected, actual, relative):
+    largest = 0.0
+    diff = 0.0
+    for idx in range(len(expected)):
+        largest = max(largest, abs(expected[idx]))
+        diff = max(diff, abs(actual[idx] - expected[idx]))
+    return diff/largest if relative and largest > 0 else diff
+
+def check_kernels():
+    # runs every backend over the same simulated subpages of both readout
+    # patterns and compares the planes and temperature maps with the
+    # reference kernel's, returns { backend : { ... } }
+    pipe = Pipeline()
+    camera = pipe.camera
+    state = pipe.state
+    images = {}
+    for name in KERNELS:
+        images[name] = ProcessedImage(pipe.calib, backend=name)
+        images[name].set_exclusions(pipe.bad_pix)
+    reference = images.pop('reference')
+    expected = array('f', bytes(4*IMAGE_SIZE))
+    temps = array('f', bytes(4*IMAGE_SIZE))
+
+    results = {}
+    for name in images:
+        plane_tol, temp_tol = KERNEL_TOLERANCE.get(name, _DEFAULT_KERNEL_TOLERANCE)
+        results[name] = {
+            'plane_diff': 0.0,
+            'plane_tolerance': plane_tol,
+            'temperature_diff': 0.0,
+            'temperature_tolerance': temp_tol,
+        }
+
+    for pattern in (ChessPattern, InterleavedPattern):
+        camera.configure(pattern=pattern)
+        for _ in range(_KERNEL_CHECK_SUBPAGES):
+            pipe.next_subpage()
+            camera.read_image(pipe.sp_id)
+            camera.read_state(out=state)
+            subpage = camera.last_read
+            reference.update(camera.raw.pix, subpage, state)
+            reference.temperature_map(expected, state)
+            for name, image in images.items():
+                result = results[name]
+                image.update(camera.raw.pix, subpage, state)
+                for plane in ('v_ir', 'alpha', 'buf'):
+                    diff = _max_difference(getattr(reference, plane), getattr(image, plane), True)
+                    result['plane_diff'] = max(result['plane_diff'], diff)
+                image.temperature_map(temps, state)
+                diff = _max_difference(expected, temps, False)
+                result['temperature_diff'] = max(result['temperature_diff'], diff)
+    return results
+
+
+def run_stages(frames, calib_runs):
+    pipe = Pipeline()
+    camera = pipe.camera
+    image = pipe.image
+    results = {}
+
+    eeprom_image = camera.eeprom_image
+    eeprom = camera.eeprom
+    results['calibration'] = measure(
+        lambda: CameraCalibration(eeprom_image, eeprom), calib_runs)
+
+    raw = RawImage()
+    iface = camera.iface
+    subpage = lambda: get_subpage(ChessPattern, pipe.sp_id)
+    results['raw_read'] = measure(
+        lambda: raw.read(iface, subpage()), frames, pipe.next_subpage)
+
+    results['read_state'] = measure(lambda: camera.read_state(out=pipe.state), frames)
+
+    state = pipe.state
+    results['update'] = measure(
+        lambda: image.update(camera.raw.pix, subpage(), state), frames, pipe.next_subpage)
+
+    sp_limits = [None]*4
+    for name, mode in (('temporal_ema', FILTER_EMA), ('temporal_box', FILTER_BOX)):
+        temporal = TemporalFilter(mode)
+        results[name] = measure(
+            lambda: temporal.apply(image, subpage(), state, sp_limits), frames, pipe.next_subpage)
+
+    results['interpolate'] = measure(
+        lambda: image.interpolate_bad_pixels(pipe.interp_plan), frames)
+
+    results['limits'] = measure(image.calc_limits, frames, image.invalidate_limits)
+
+    temps = pipe.temps
+    results['temperature_map'] = measure(
+        lambda: image.temperature_map(temps, state), frames)
+
+    gradient = pipe.gradient
+    limits = image.calc_limits()
+    gradient.h_scale = (limits.min_h, limits.max_h)
+    pens = pipe.pens
+    results['quantize'] = measure(lambda: gradient.quantize(image.buf, pens), frames)
+
+    pixmap = pipe.pixmap
+    results['draw_map'] = measure(
+        lambda: pixmap.draw_map(DISPLAY, gradient), frames, pipe.next_frame)
+    results['draw_map_full'] = measure(
+        lambda: pixmap.draw_map(DISPLAY, gradient, force=True), frames)
+
+    for mode in (2, 4, 'fit'):
+        pixmap.set_upscale(mode)
+        results[f'draw_map_upscale_{mode}'] = measure(
+            lambda: pixmap.draw_map(DISPLAY, gradient), frames)
+    pixmap.set_upscale(1)
+
+    # the device's read loop without rendering, everything here is reused
+    # from frame to frame and only the per-pixel float math should allocate
+    results['steady_state'] = measure(pipe.process, frames)
+
+    pipe.bus.stats.reset()
+    DISPLAY.reset_counts()
+    results['end_to_end'] = measure(pipe.step, frames)
+    bus = pipe.bus.stats.as_dict()
+    bus['per_frame_bytes'] = pipe.bus.stats.bytes//frames
+    bus['per_frame_transactions'] = pipe.bus.stats.transactions//frames
+
+    return {
+        'implementation': sys.implementation.name,
+        'frames': frames,
+        'alloc_unit': ALLOC_UNIT,
+        'stages': results,
+        'kernels': check_kernels(),
+        'bus': bus,
+        'display': {
+            'pens_set': DISPLAY.pens_set,
+            'shapes': DISPLAY.shapes,
+            'pixels': DISPLAY.pixels,
+        },
+    }
+
+
+def compare(result, baseline, tolerance):
+    # returns a list of regression messages
+    regressions = []
+    check_alloc = result['alloc_unit'] == 'bytes' and baseline.get('alloc_unit') == 'bytes'
+    for name, stage in result['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        limit = base['median_us']*(1 + tolerance)
+        if stage['median_us'] > limit:
+            regressions.append(f"{name}: {stage['median_us']} us, baseline {base['median_us']} us")
+        limit = base['alloc']*(1 + tolerance) + _ALLOC_SLACK
+        if check_alloc and stage['alloc'] > limit:
+            regressions.append(f"{name}: allocates {stage['alloc']} bytes, baseline {base['alloc']} bytes")
+    return regressions
+
+
+def _parse_args(argv):
+    options = {
+        'frames': 64,
+        'calib_runs': 3,
+        'output': None,
+        'baseline': None,
+        'tolerance': DEFAULT_TOLERANCE,
+        'max_frame_alloc': None,
+    }
+    convert = {'frames': int, 'calib_runs': int, 'tolerance': float, 'max_frame_alloc': int}
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith('--'):
+            raise ValueError(f"unexpected argument: {arg}")
+        name = arg[2:].replace('-', '_')
+        if name not in options:
+            raise ValueError(f"unknown option: {arg}")
+        value = next(args)
+        options[name] = convert[name](value) if name in convert else value
+    return options
+
+def main(argv):
+    options = _parse_args(argv)
+    result = run_stages(options['frames'], options['calib_runs'])
+
+    text = json.dumps(result)
+    if options['output'] is not None:
+        with open(options['output'], 'w') as out:
+            out.write(text)
+    else:
+        print(text)
+
+    regressions = []
+    if options['baseline'] is not None:
+        with open(options['baseline']) as base_file:
+            baseline = json.load(base_file)
+        regressions = compare(result, baseline, options['tolerance'])
+
+    max_alloc = options['max_frame_alloc']
+    frame_alloc = result['stages']['steady_state']['alloc']
+    if max_alloc is not None and ALLOC_UNIT == 'bytes' and frame_alloc > max_alloc:
+        regressions.append(f"steady_state: allocates {frame_alloc} bytes per subpage, limit {max_alloc} bytes")
+
+    for name, kernel in result['kernels'].items():
+        if kernel['plane_diff'] > kernel['plane_tolerance']:
+            regressions.append(f"{name} kernel: differs from the reference by {kernel['plane_diff']:.3g} (relative), "
+                               f"tolerance {kernel['plane_tolerance']:.3g}")
+        if kernel['temperature_diff'] > kernel['temperature_tolerance']:
+            regressions.append(f"{name} kernel: temperatures differ from the reference by {kernel['temperature_diff']:.3g} degC, "
+                               f"tolerance {kernel['temperature_tolerance']:.3g} degC")
+
+    for msg in regressions:
+        print(f"REGRESSION {msg}")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,309 @@
+""" Offline replay of recorded sessions (mlx90640.recording) on a host.
+
+Records are fed through the device's own calibration and compensation code
+(CameraCalibration, MLX90640.read_state() and ProcessedImage) as a chain of
+generators, one record at a time, so memory use does not depend on the
+length of the recording. Runs under CPython:
+
+    python3 bench/replay.py RECORDING [options]
+
+Options:
+    --start N           first record to replay (default 0)
+    --stop N            record to stop before (default the end of the recording)
+    --workers N         processes to shard the records over (default 1)
+    --backend NAME      compensation kernel, see mlx90640.compensation.KERNELS
+    --bad-pixels LIST   comma separated pixel indices to interpolate, on top
+                        of those flagged in the EEPROM
+    --filter MODE       temporal noise filter, 'ema' or 'box' (default none)
+    --filter-frames N   length of the temporal filter (default 4)
+    --csv PATH          write per frame statistics as CSV
+    --maps PATH         write the temperature maps as raw float32, one
+                        IMAGE_SIZE frame after another
+    --pgm DIR           write every frame to DIR as an 8 bit PGM image
+
+A frame is emitted for every record, after its subpage has been merged with
+the other one. Shards start one record early to fill in the other subpage,
+so the output does not depend on the number of workers. With a temporal
+filter they start early enough for it to settle, but the output at shard
+boundaries can differ slightly. A JSON summary with the throughput in
+frames per second is printed at the end.
+"""
+
+import sys
+import json
+import os
+
+def _setup_path():
+    here = __file__.rpartition('/')[0] or '.'
+    sys.path.insert(0, here + '/../src')
+    sys.path.insert(0, here + '/cpython')
+    import mpcompat
+
+_setup_path()
+
+import time
+from array import array
+
+import mlx90640
+from mlx90640.regmap import (
+    REGISTER_MAP,
+    CONTROL_ADDRESS,
+    AUX_ADDRESS,
+    AUX_SIZE,
+    RegisterMap,
+    MemorySnapshot,
+)
+from mlx90640.calibration import CameraCalibration, NUM_ROWS, NUM_COLS, IMAGE_SIZE
+from mlx90640.compensation import DEFAULT_BACKEND
+from mlx90640.image import ProcessedImage, InterpolationPlan, merge_bad_pixels, get_pattern_by_id
+from mlx90640.recording import RecordingReader, Record
+from mlx90640.temporal import TemporalFilter, FILTER_EMA, FILTER_BOX
+
+_FILTER_MODES = {'ema': FILTER_EMA, 'box': FILTER_BOX}
+
+_CSV_HEADER = 'seq,time_ms,subpage,vdd,ta,min,max,mean\n'
+
+class ReplayCamera(mlx90640.MLX90640):
+    # an MLX90640 whose registers and RAM are filled from recorded subpages
+    def __init__(self, eeprom, *, backend=DEFAULT_BACKEND):
+        super().__init__(None, None)
+        self.memory = MemorySnapshot(((CONTROL_ADDRESS, 1), (AUX_ADDRESS, AUX_SIZE)))
+        self.registers = RegisterMap(self.memory, REGISTER_MAP, readonly=True)
+        self.eeprom_image.buf[:] = eeprom
+        calib = CameraCalibration(self.eeprom_image, self.eeprom)
+        self.setup(calib=calib, image=ProcessedImage(calib, backend=backend))
+        self.calib_source = 'eeprom'
+
+    def read_aux(self):
+        return self.registers
+
+    def load(self, record):
+        # stands in for the bus traffic of read_image() and read_state()
+        control, aux = self.memory.images
+        control.buf[:] = record.control
+        aux.buf[:] = record.aux
+        self.pattern = get_pattern_by_id(self.registers['read_pattern'])
+        record.unpack_pixels(self.raw.pix)
+        self.last_read = record.subpage
+
+
+## Generator pipeline
+
+def iter_frames(reader, camera, start, stop, *, warmup=0, bad_pixels=()):
+    # yields (record, state, temperatures) for records start to stop, the
+    # record and buffers are reused, so copy anything that should be kept
+    plan = InterpolationPlan(merge_bad_pixels(camera.calib, bad_pixels))
+    camera.image.set_exclusions(plan.bad_pixels)
+    state = mlx90640.CameraState()
+    temps = array('f', bytes(4 * IMAGE_SIZE))
+    for record in reader.iter_records(max(start - warmup, 0), stop, Record()):
+        camera.load(record)
+        camera.read_state(out=state)
+        image = camera.process_image(record.sp_id, state)
+        image.interpolate_bad_pixels(plan)
+        if record.seq < start:
+            continue
+        image.temperature_map(temps, state)
+        yield record, state, temps
+
+def with_stats(frames):
+    # adds (min, max, mean) of the temperatures
+    for record, state, temps in frames:
+        yield record, state, temps, (min(temps), max(temps), sum(temps)/len(temps))
+
+def write_csv(frames, out):
+    for frame in frames:
+        record, state, _, (t_min, t_max, t_mean) = frame
+        out.write(f"{record.seq},{record.time_ms},{record.sp_id},"
+                  f"{state.vdd:.4f},{state.ta + 25:.3f},{t_min:.3f},{t_max:.3f},{t_mean:.3f}\n")
+        yield frame
+
+def write_maps(frames, out):
+    for frame in frames:
+        frame[2].tofile(out)
+        yield frame
+
+def write_pgm(frames, directory):
+    pixels = bytearray(IMAGE_SIZE)
+    header = f"P5\n{NUM_COLS} {NUM_ROWS}\n255\n".encode()
+    for frame in frames:
+        record, _, temps, (t_min, t_max, _) = frame
+        scale = 255/(t_max - t_min) if t_max > t_min else 0
+        for idx in range(IMAGE_SIZE):
+            pixels[idx] = int((temps[idx] - t_min)*scale)
+        with open(f"{directory}/{record.seq:08d}.pgm", 'wb') as out:
+            out.write(header)
+            out.write(pixels)
+        yield frame
+
+
+## Shards
+
+def _part_path(path, shard):
+    return f"{path}.part{shard}"
+
+def _warmup(start, options):
+    # records needed ahead of start to fill in the other subpage and settle the filter
+    if options['filter'] is not None:
+        return 4*options['filter_frames'] if start > 0 else 0
+    return 1 if start > 0 else 0
+
+def run_shard(args):
+    # replays records start to stop, returns a summary
+    # the csv and maps outputs are written to per shard part files
+    shard, path, start, stop, options = args
+    started = time.perf_counter()
+    reader = RecordingReader(path)
+    camera = ReplayCamera(reader.eeprom, backend=options['backend'])
+    if options['filter'] is not None:
+        camera.image.set_filter(TemporalFilter(
+            _FILTER_MODES[options['filter']], frames=options['filter_frames']))
+    calib_s = time.perf_counter() - started
+
+    outputs = []
+    frames = with_stats(iter_frames(
+        reader, camera, start, stop,
+        warmup=_warmup(start, options), bad_pixels=options['bad_pixels'],
+    ))
+    if options['csv'] is not None:
+        outputs.append(open(_part_path(options['csv'], shard), 'w'))
+        frames = write_csv(frames, outputs[-1])
+    if options['maps'] is not None:
+        outputs.append(open(_part_path(options['maps'], shard), 'wb'))
+        frames = write_maps(frames, outputs[-1])
+    if options['pgm'] is not None:
+        frames = write_pgm(frames, options['pgm'])
+
+    count = 0
+    t_min = t_max = None
+    mean_sum = 0.0
+    started = time.perf_counter()
+    for _, _, _, (f_min, f_max, f_mean) in frames:
+        count += 1
+        mean_sum += f_mean
+        t_min = f_min if t_min is None else min(t_min, f_min)
+        t_max = f_max if t_max is None else max(t_max, f_max)
+    elapsed = time.perf_counter() - started
+
+    for out in outputs:
+        out.close()
+    reader.close()
+    return {
+        'shard': shard,
+        'frames': count,
+        'calib_s': calib_s,
+        'elapsed_s': elapsed,
+        'min': t_min,
+        'max': t_max,
+        'mean_sum': mean_sum,
+    }
+
+def _join_parts(path, shards, header=None):
+    with open(path, 'wb') as out:
+        if header is not None:
+            out.write(header)
+        for shard in range(shards):
+            part = _part_path(path, shard)
+            with open(part, 'rb') as src:
+                while True:
+                    chunk = src.read(1 << 16)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            os.remove(part)
+
+def replay(path, options):
+    reader = RecordingReader(path)
+    records = len(reader)
+    reader.close()
+    start = options['start']
+    stop = min(options['stop'] if options['stop'] is not None else records, records)
+    workers = max(options['workers'], 1)
+
+    step = max(-(-(stop - start) // workers), 1)
+    jobs = [
+        (shard, path, first, min(first + step, stop), options)
+        for shard, first in enumerate(range(start, stop, step))
+    ]
+
+    started = time.perf_counter()
+    if workers > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+        with Pool(min(workers, len(jobs))) as pool:
+            shards = pool.map(run_shard, jobs)
+    else:
+        shards = [run_shard(job) for job in jobs]
+    elapsed = time.perf_counter() - started
+
+    if options['csv'] is not None:
+        _join_parts(options['csv'], len(jobs), _CSV_HEADER.encode())
+    if options['maps'] is not None:
+        _join_parts(options['maps'], len(jobs))
+
+    frames = sum(s['frames'] for s in shards)
+    busy = sum(s['elapsed_s'] for s in shards)
+    mins = [s['min'] for s in shards if s['min'] is not None]
+    maxs = [s['max'] for s in shards if s['max'] is not None]
+    return {
+        'recording': path,
+        'records': records,
+        'frames': frames,
+        'workers': len(jobs) if workers > 1 else 1,
+        'backend': options['backend'],
+        'elapsed_s': elapsed,
+        'fps': frames/elapsed if elapsed > 0 else None,
+        # throughput of one worker, without calibration and process start up
+        'fps_per_worker': frames/busy if busy > 0 else None,
+        'min': min(mins) if mins else None,
+        'max': max(maxs) if maxs else None,
+        'mean': sum(s['mean_sum'] for s in shards)/frames if frames else None,
+    }
+
+
+def _parse_args(argv):
+    options = {
+        'start': 0,
+        'stop': None,
+        'workers': 1,
+        'backend': DEFAULT_BACKEND,
+        'bad_pixels': (),
+        'filter': None,
+        'filter_frames': 4,
+        'csv': None,
+        'maps': None,
+        'pgm': None,
+    }
+    convert = {
+        'start': int,
+        'stop': int,
+        'workers': int,
+        'filter_frames': int,
+        'bad_pixels': lambda value: tuple(int(idx) for idx in value.split(',') if idx),
+    }
+    path = None
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith('--'):
+            if path is not None:
+                raise ValueError(f"unexpected argument: {arg}")
+            path = arg
+            continue
+        name = arg[2:].replace('-', '_')
+        if name not in options:
+            raise ValueError(f"unknown option: {arg}")
+        value = next(args)
+        options[name] = convert[name](value) if name in convert else value
+    if path is None:
+        raise ValueError("no recording given")
+    if options['filter'] is not None and options['filter'] not in _FILTER_MODES:
+        raise ValueError(f"unknown filter: {options['filter']}")
+    return path, options
+
+def main(argv):
+    path, options = _parse_args(argv)
+    if options['pgm'] is not None:
+        os.makedirs(options['pgm'], exist_ok=True)
+    print(json.dumps(replay(path, options)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,381 @@
+""" Simulated MLX90640 on a fake I2C bus.
+
+SimulatedI2C implements the parts of machine.I2C used by CameraInterface and
+detect_camera, backed by an EEPROM image and a source of RAM frames. Subpages
+are measured on a timer following the refresh rate in the control register,
+with the status register behaving as on the device. Every transaction is
+counted per address range so that bus usage can be measured.
+"""
+
+import math
+import time
+
+from mlx90640.regmap import (
+    REG_SIZE,
+    EEPROM_ADDRESS,
+    EEPROM_SIZE,
+    STATUS_ADDRESS,
+    CONTROL_ADDRESS,
+)
+from mlx90640.calibration import IMAGE_SIZE, NUM_COLS
+from mlx90640.image import get_pattern_by_id
+
+DEFAULT_ADDR = const(0x33)
+
+RAM_ADDRESS = const(0x0400)
+RAM_SIZE    = const(0x0340)
+AUX_OFFSET  = const(0x0300)  # auxiliary data follows the pixels in RAM
+
+REGISTER_ADDRESS = const(0x8000)
+REGISTER_SIZE    = const(0x0020)
+
+# (name, first address, size in words)
+REGIONS = (
+    ('ram',       RAM_ADDRESS,      RAM_SIZE),
+    ('eeprom',    EEPROM_ADDRESS,   EEPROM_SIZE),
+    ('registers', REGISTER_ADDRESS, REGISTER_SIZE),
+)
+
+# power-on register values
+_REGISTER_DEFAULTS = {
+    CONTROL_ADDRESS : 0x1901,  # 2 Hz, 18 bit ADC, chess pattern, subpages enabled
+    0x8010 : 0xBE33,  # I2C address
+}
+
+# status register bits
+_LAST_SUBPAGE  = const(0x0007)
+_DATA_AVAIL    = const(0x0008)
+_OVERWRITE     = const(0x0010)
+
+# control register bits
+_SUBPAGE_EN    = const(0x0001)
+_DATA_HOLD     = const(0x0004)
+_SUBPAGE_REP   = const(0x0008)
+
+# bytes on the wire besides the data: device address and 16 bit memory
+# address, plus the repeated device address of a read
+_READ_OVERHEAD  = const(4)
+_WRITE_OVERHEAD = const(3)
+
+
+def _put_word(buf, offset, value):
+    buf[offset*REG_SIZE] = (value >> 8) & 0xFF
+    buf[offset*REG_SIZE + 1] = value & 0xFF
+
+def _get_word(buf, offset):
+    return buf[offset*REG_SIZE] << 8 | buf[offset*REG_SIZE + 1]
+
+class _Random:
+    # xorshift32, deterministic between CPython and MicroPython
+    def __init__(self, seed):
+        self.state = seed or 1
+
+    def next(self):
+        x = self.state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self.state = x
+        return x
+
+    def randint(self, lo, hi):
+        return lo + self.next() % (hi - lo + 1)
+
+
+## EEPROM images
+
+# calibration parameters after the worked example in the datasheet
+_SYNTHETIC_EEPROM = {
+    0x2410 : 0x4222,  # k_ptat, offset scales
+    0x2411 : 0xFFC4,  # pix_os_average (-60)
+    0x2420 : 0x7222,  # alpha_scale, sensitivity scales
+    0x2421 : 0x2F44,  # pix_sensitivity_average
+    0x2430 : 0x18EF,  # gain
+    0x2431 : 0x2FF1,  # ptat_25
+    0x2432 : 0x5952,  # kv_ptat, kt_ptat
+    0x2433 : 0x9D68,  # k_vdd, vdd_25
+    0x2434 : 0x4444,  # kv_avg
+    0x2436 : 0x5353,  # kta_avg
+    0x2437 : 0x5353,
+    0x2438 : 0x2363,  # res_ctrl_cal, kv/kta scales
+    0x2439 : 0x04E2,  # cp_sp_ratio, alpha_cp_sp_0
+    0x243A : 0xFBB5,  # offset_cp_delta, offset_cp_sp_0
+    0x243C : 0xF000,  # ksta, tgc
+    0x243D : 0x9797,  # ksto
+    0x243E : 0x9797,
+    0x243F : 0x2889,  # step, ct4, ct3, ksto_scale
+}
+
+def synthetic_eeprom(*, seed=1, failed=(), outliers=()):
+    # an EEPROM image with plausible calibration values and a small random
+    # spread of per-pixel corrections
+    eeprom = bytearray(EEPROM_SIZE * REG_SIZE)
+    for address, value in _SYNTHETIC_EEPROM.items():
+        _put_word(eeprom, address - EEPROM_ADDRESS, value)
+
+    rand = _Random(seed)
+    pix_offset = 0x2440 - EEPROM_ADDRESS
+    for idx in range(IMAGE_SIZE):
+        offset = rand.randint(-8, 7) & 0x3F
+        alpha = rand.randint(-8, 7) & 0x3F
+        kta = rand.randint(-2, 1) & 0x07
+        word = offset << 10 | alpha << 4 | kta << 1
+        if idx in outliers:
+            word |= 1
+        if idx in failed:
+            word = 0
+        elif word == 0:
+            word = 1 << 4
+        _put_word(eeprom, pix_offset + idx, word)
+    return eeprom
+
+def load_eeprom(path):
+    # raw EEPROM dump, as in MemoryImage.buf
+    with open(path, 'rb') as dump:
+        eeprom = bytearray(dump.read())
+    if len(eeprom) != EEPROM_SIZE * REG_SIZE:
+        raise ValueError(f"EEPROM dump should be {EEPROM_SIZE * REG_SIZE} bytes: {len(eeprom)}")
+    return eeprom
+
+
+## RAM frames
+
+# auxiliary data after the worked example in the datasheet
+_SYNTHETIC_AUX = {
+    0x0700 : 0x4BF2,  # ta_vbe
+    0x0708 : 0xFFCA,  # cp_sp_0
+    0x070A : 0x1881,  # gain
+    0x0720 : 0x06AF,  # ta_ptat
+    0x0728 : 0xFFC8,  # cp_sp_1
+    0x072A : 0xCCC5,  # vdd_pix
+}
+
+class SyntheticScene:
+    # cycles through count RAM images of a warm blob circling over an
+    # ambient background, with some pixel noise. the images are built up
+    # front so that producing a frame costs nothing.
+    def __init__(self, count=16, *, seed=1, background=-60, blob=700, noise=4):
+        rand = _Random(seed)
+        self.frames = []
+        for k in range(count):
+            ram = bytearray(RAM_SIZE * REG_SIZE)
+            angle = 6.2832*k/count
+            cx = 16 + 9*math.cos(angle)
+            cy = 12 + 6*math.sin(angle)
+            for idx in range(IMAGE_SIZE):
+                row, col = divmod(idx, NUM_COLS)
+                d2 = (col - cx)**2 + (row - cy)**2
+                value = background + rand.randint(-noise, noise)
+                if d2 < 16:
+                    value += int(blob*(1 - d2/16))
+                _put_word(ram, idx, value & 0xFFFF)
+            for address, value in _SYNTHETIC_AUX.items():
+                _put_word(ram, address - RAM_ADDRESS, value)
+            self.frames.append(ram)
+        self._next = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        frame = self.frames[self._next]
+        self._next = (self._next + 1) % len(self.frames)
+        return frame
+
+## Clocks
+
+class RealClock:
+    # monotonic microseconds from time.ticks_us
+    def __init__(self):
+        self._last = time.ticks_us()
+        self.now_us = 0
+
+    def __call__(self):
+        now = time.ticks_us()
+        self.now_us += time.ticks_diff(now, self._last)
+        self._last = now
+        return self.now_us
+
+class ManualClock:
+    # time only moves when advanced, for deterministic runs
+    def __init__(self, start_us=0):
+        self.now_us = start_us
+
+    def __call__(self):
+        return self.now_us
+
+    def advance(self, us):
+        self.now_us += us
+
+
+## Bus
+
+class BusStats:
+    def __init__(self, bus_freq):
+        self.bus_freq = bus_freq
+        # { region name : [read transactions, bytes read, write transactions, bytes written] }
+        self.regions = {name: [0, 0, 0, 0] for name, _, _ in REGIONS}
+        self.bus_time_us = 0.0  # estimated time on the wire
+
+    def reset(self):
+        for counts in self.regions.values():
+            for i in range(4):
+                counts[i] = 0
+        self.bus_time_us = 0.0
+
+    def count(self, region, nbytes, write):
+        counts = self.regions[region]
+        counts[2 if write else 0] += 1
+        counts[3 if write else 1] += nbytes
+        overhead = _WRITE_OVERHEAD if write else _READ_OVERHEAD
+        # 9 clocks per byte including the ack
+        self.bus_time_us += (nbytes + overhead)*9*1000000/self.bus_freq
+
+    @property
+    def transactions(self):
+        return sum(counts[0] + counts[2] for counts in self.regions.values())
+
+    @property
+    def bytes(self):
+        return sum(counts[1] + counts[3] for counts in self.regions.values())
+
+    def as_dict(self):
+        result = {
+            name: {
+                'reads': counts[0], 'bytes_read': counts[1],
+                'writes': counts[2], 'bytes_written': counts[3],
+            }
+            for name, counts in self.regions.items()
+        }
+        result['bus_time_us'] = int(self.bus_time_us)
+        return result
+
+class SimulatedI2C:
+    def __init__(self, eeprom=None, frames=None, *, addr=DEFAULT_ADDR, clock=None, drift=1.0, bus_freq=400000):
+        # eeprom is an EEPROM image (see synthetic_eeprom/load_eeprom)
+        # frames should be an iterator of full RAM images (RAM_SIZE words),
+        # one is taken for every measured subpage
+        # drift scales the subpage period, like an oscillator running off nominal
+        self.addr = addr
+        self.frames = frames if frames is not None else SyntheticScene()
+        self.clock = clock or RealClock()
+        self.drift = drift
+        self.stats = BusStats(bus_freq)
+
+        self.ram = bytearray(RAM_SIZE * REG_SIZE)
+        self.eeprom = bytearray(eeprom if eeprom is not None else synthetic_eeprom())
+        self.regs = bytearray(REGISTER_SIZE * REG_SIZE)
+        for address, value in _REGISTER_DEFAULTS.items():
+            _put_word(self.regs, address - REGISTER_ADDRESS, value)
+        self._memory = (self.ram, self.eeprom, self.regs)
+
+        # subpage measurement
+        self.measured = 0  # subpages measured
+        self.dropped = 0   # subpages not transferred to RAM because data was held
+        self._sp_id = 1
+        self._epoch = self.clock()
+        self._count = 0  # subpages measured since the epoch
+
+    ## machine.I2C
+
+    def scan(self):
+        return [self.addr]
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr, memaddr, buf, addrsize=addrsize)
+        return bytes(buf)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        mem, offset, region = self._locate(addr, memaddr, len(buf), addrsize)
+        self._update()
+        self.stats.count(region, len(buf), False)
+        buf[:] = memoryview(mem)[offset*REG_SIZE:offset*REG_SIZE + len(buf)]
+
+    def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
+        mem, offset, region = self._locate(addr, memaddr, len(buf), addrsize)
+        self._update()
+        self.stats.count(region, len(buf), True)
+        if region != 'registers':
+            raise OSError(f"write to read-only memory: {memaddr:#06x}")
+        for i in range(0, len(buf), REG_SIZE):
+            self._write_register(memaddr + i//REG_SIZE, buf[i] << 8 | buf[i + 1])
+
+    def _locate(self, addr, memaddr, nbytes, addrsize):
+        if addr != self.addr:
+            raise OSError(19)  # ENODEV, as when nothing acks
+        if addrsize != 16 or nbytes % REG_SIZE:
+            raise OSError("MLX90640 needs 16 bit addressing and whole words")
+        count = nbytes//REG_SIZE
+        for mem, (name, start, size) in zip(self._memory, REGIONS):
+            if start <= memaddr and memaddr + count <= start + size:
+                return mem, memaddr - start, name
+        raise OSError(f"address range not mapped: {memaddr:#06x}+{count}")
+
+    ## Registers
+
+    def _register(self, address):
+        return _get_word(self.regs, address - REGISTER_ADDRESS)
+
+    def _write_register(self, address, value):
+        if address == STATUS_ADDRESS:
+            # only overwrite_enable is writable, data_available can only be cleared
+            status = self._register(STATUS_ADDRESS)
+            status = (status & ~_OVERWRITE) | (value & _OVERWRITE)
+            if not value & _DATA_AVAIL:
+                status &= ~_DATA_AVAIL
+            value = status
+        elif address == CONTROL_ADDRESS:
+            if (value ^ self._register(CONTROL_ADDRESS)) & 0x0380:
+                # a new refresh rate starts timing over
+                self._epoch = self.clock()
+                self._count = 0
+        _put_word(self.regs, address - REGISTER_ADDRESS, value)
+
+    @property
+    def subpage_period_us(self):
+        rate = (self._register(CONTROL_ADDRESS) >> 7) & 0x7
+        return self.drift*1000000/2.0**(rate - 1)
+
+    ## Measurement
+
+    def _update(self):
+        # measure the subpages that have completed since the last access
+        due = int((self.clock() - self._epoch)/self.subpage_period_us)
+        new = due - self._count
+        if new <= 0:
+            return
+        self._count = due
+        for _ in range(new):
+            self._measure()
+
+    def _measure(self):
+        self.measured += 1
+        frame = next(self.frames)
+
+        control = self._register(CONTROL_ADDRESS)
+        if not control & _SUBPAGE_EN:
+            sp_id = 0
+        elif control & _SUBPAGE_REP:
+            sp_id = (control >> 4) & 0x1
+        else:
+            sp_id = self._sp_id ^ 1
+        self._sp_id = sp_id
+
+        status = self._register(STATUS_ADDRESS)
+        if control & _DATA_HOLD and not status & _OVERWRITE and status & _DATA_AVAIL:
+            self.dropped += 1
+            return
+
+        pattern = get_pattern_by_id((control >> 12) & 0x1)
+        ram = self.ram
+        if control & _SUBPAGE_EN:
+            for idx in pattern.sp_indices(sp_id):
+                ram[idx*REG_SIZE] = frame[idx*REG_SIZE]
+                ram[idx*REG_SIZE + 1] = frame[idx*REG_SIZE + 1]
+        else:
+            ram[:AUX_OFFSET*REG_SIZE] = frame[:AUX_OFFSET*REG_SIZE]
+        ram[AUX_OFFSET*REG_SIZE:] = frame[AUX_OFFSET*REG_SIZE:]
+
+        status = (status & ~_LAST_SUBPAGE) | sp_id | _DATA_AVAIL
+        _put_word(self.regs, STATUS_ADDRESS - REGISTER_ADDRESS, status)
@@ -0,0 +1,272 @@
+""" Allocation test of the steady-state frame loop:
+
+    micropython bench/test_alloc.py [--subpages N]
+    python3 bench/test_alloc.py [--subpages N]
+
+Drives each stage of Pipeline.process_ready() (acquisition, compensation,
+interpolation and publishing of a subpage), the float-free helpers around it,
+and then process_ready() as a whole, through a warm-up and N subpages, and
+checks what every call allocates against its entry in BUDGETS.
+
+The only allocations left in the loop are the boxes of intermediate floats, so
+the budgets are counts of float boxes. They are the counts alloc_model.py
+reports for the chess pattern, with _MARGIN_BOXES of slack for the stages that
+box floats at all; the others must not allocate. A single new buffer, such as
+a bytearray for a RAM page, is well past the margin.
+
+Under MicroPython the gc.mem_alloc() delta of each call is rounded up to whole
+float boxes (one GC block each on ports that box floats; on ports with
+immediate floats every call must allocate nothing). The simulated camera
+allocates for every bus transaction, that cost is measured per region and
+direction up front and subtracted, using the transaction counts of the
+simulator's BusStats. CPython has no gc.mem_alloc(), so there the driver is
+imported through alloc_model.py, which counts the float boxes and other
+objects MicroPython would allocate; other objects must be 0.
+
+The test runs the default compensation backend, which on the device is
+'fused'. The 'array' backend allocates whole-frame temporaries and is not
+covered; it is the default under CPython when numpy is installed, so there
+'fused' is selected explicitly.
+
+Exits 1 on failure.
+"""
+
+import sys
+import gc
+
+if hasattr(gc, 'mem_alloc'):
+    _model = None
+else:
+    import alloc_model
+    _model = alloc_model.install()
+
+from pipeline import Pipeline
+
+from mlx90640.regmap import STATUS_ADDRESS
+from sim import RAM_ADDRESS
+from mlx90640.image import ChessPattern, get_subpage
+from mlx90640.assembler import FrameAssembler
+
+_WARMUP = const(8)
+_SUBPAGES = const(32)
+
+_BACKEND = 'fused'
+_SUBPAGE_PIXELS = const(384)
+_MARGIN_BOXES = const(8)
+
+# float boxes per call, from alloc_model.py. process_image() boxes 16 per
+# pixel in the chess branch of FusedKernel.update(): 8 for the offset, 4 for
+# v_ir, 3 for alpha and 1 for h
+PROCESS_READY_STAGES = (
+    ('read_status', 0),
+    ('read_image', 0),
+    ('read_state', 17),
+    ('process_image', 16*_SUBPAGE_PIXELS + 5),
+    ('interpolate', 114),
+    ('publish', 173),
+)
+BUDGETS = PROCESS_READY_STAGES + (
+    ('read_control', 0),
+    ('read_aux', 0),
+    ('get_subpage', 0),
+    ('assembler.add', 0),
+)
+
+def budget_of(boxes):
+    # allowed float boxes for a call that boxes the given number
+    return boxes + _MARGIN_BOXES if boxes else 0
+
+
+def float_box_size():
+    # bytes allocated for an intermediate float, 0 with immediate floats
+    x = 1.5
+    gc.collect()
+    gc.disable()
+    start = gc.mem_alloc()
+    y = x * 3.0
+    size = gc.mem_alloc() - start
+    gc.enable()
+    return size
+
+def _transactions(stats):
+    # (region, direction) -> count
+    counts = {}
+    for region, (reads, _, writes, _) in stats.regions.items():
+        counts[region, 'read'] = reads
+        counts[region, 'write'] = writes
+    return counts
+
+def alloc_of(func, stats):
+    # bytes allocated by func(), and the bus transactions it made
+    before = _transactions(stats)
+    gc.collect()
+    gc.disable()
+    start = gc.mem_alloc()
+    func()
+    alloc = gc.mem_alloc() - start
+    gc.enable()
+    after = _transactions(stats)
+    return alloc, {key: after[key] - before[key] for key in after}
+
+def bus_costs(pipe):
+    # bytes the simulator allocates per transaction, by (region, direction)
+    bus = pipe.bus
+    addr = pipe.camera.iface.addr
+    stats = bus.stats
+    word = bytearray(2)
+    def read(memaddr):
+        return lambda: bus.readfrom_mem_into(addr, memaddr, word, addrsize=16)
+    def write_status():
+        # clears data_available, as read_image() does
+        bus.writeto_mem(addr, STATUS_ADDRESS, word, addrsize=16)
+
+    bus.readfrom_mem_into(addr, STATUS_ADDRESS, word, addrsize=16)
+    word[1] &= ~0x08
+    calls = {
+        ('ram', 'read'): read(RAM_ADDRESS),
+        ('registers', 'read'): read(STATUS_ADDRESS),
+        ('registers', 'write'): write_status,
+    }
+    costs = {}
+    for key, func in calls.items():
+        for _ in range(3):
+            func()  # warm up
+        costs[key] = alloc_of(func, stats)[0]
+    return costs
+
+def bus_cost(costs, transactions):
+    total = 0
+    for key, count in transactions.items():
+        if count:
+            if key not in costs:
+                raise ValueError(f"no cost measured for {key[1]}s of {key[0]}")
+            total += count*costs[key]
+    return total
+
+
+class MemAllocMeter:
+    # counts with gc.mem_alloc(), which cannot tell float boxes from other
+    # objects: everything is reported as float boxes, rounded up
+    def __init__(self, pipe):
+        self.stats = pipe.bus.stats
+        self.costs = bus_costs(pipe)
+        self.box = float_box_size()
+        print(f"float box: {self.box} bytes, bus costs: {self.costs}")
+
+    def measure(self, func):
+        # (float boxes, other allocations) of func()
+        alloc, transactions = alloc_of(func, self.stats)
+        alloc -= bus_cost(self.costs, transactions)
+        if alloc <= 0:
+            return 0, 0
+        if not self.box:
+            return 0, alloc
+        return -(-alloc // self.box), 0
+
+class ModelMeter:
+    # counts with alloc_model.py
+    def __init__(self, pipe):
+        print("CPython: counting with alloc_model.py")
+
+    def measure(self, func):
+        _model.reset()
+        _model.enabled = True
+        try:
+            func()
+        finally:
+            _model.enabled = False
+        return _model.boxes, _model.other
+
+
+def check(name, boxes, other, budget):
+    # returns a failure message, or None
+    if other:
+        sites = ''
+        if _model is not None:
+            sites = ': ' + ', '.join(f"{file}:{line} {kind}" for file, line, kind in _model.sites)
+        return f"{name}: {other} other allocations{sites}"
+    if boxes > budget:
+        return f"{name}: {boxes} float boxes, budget {budget}"
+    return None
+
+def run(subpages):
+    pipe = Pipeline()
+    camera = pipe.camera
+    if _model is None:
+        if pipe.image.backend != _BACKEND:
+            print(f"FAIL default backend is {pipe.image.backend}, not {_BACKEND}")
+            return 1
+    else:
+        pipe.image.set_backend(_BACKEND)
+    for _ in range(_WARMUP):
+        pipe.process()
+    meter = MemAllocMeter(pipe) if _model is None else ModelMeter(pipe)
+
+    assembler = FrameAssembler()
+    status = None
+    def read_image():
+        camera.read_image(pipe.sp_id, status=status)
+    def read_state():
+        camera.read_state(out=pipe.state)
+    def process_image():
+        camera.process_image(pipe.sp_id, pipe.state)
+    def interpolate():
+        pipe.image.interpolate_bad_pixels(pipe.interp_plan)
+    def publish():
+        pipe.frames.publish(pipe.image, pipe.state)
+    calls = {
+        'read_status': camera.read_status,
+        'read_image': read_image,
+        'read_state': read_state,
+        'process_image': process_image,
+        'interpolate': interpolate,
+        'publish': publish,
+        'read_control': camera.read_control,
+        'read_aux': camera.read_aux,
+        'get_subpage': lambda: get_subpage(ChessPattern, pipe.sp_id),
+        'assembler.add': lambda: assembler.add(camera.last_read, pipe.state),
+    }
+
+    failures = 0
+    worst = {}
+    for i in range(_WARMUP + subpages):
+        pipe.next_subpage()
+        status = camera.read_status()
+        for name, boxes in BUDGETS:
+            measured, other = meter.measure(calls[name])
+            if i < _WARMUP:
+                continue
+            worst[name] = max(worst.get(name, 0), measured)
+            failure = check(name, measured, other, budget_of(boxes))
+            if failure:
+                print(f"FAIL subpage {i - _WARMUP} {failure}")
+                failures += 1
+
+    # the whole subpage at once
+    name = 'process_ready'
+    total = sum(boxes for _, boxes in PROCESS_READY_STAGES)
+    for i in range(_WARMUP + subpages):
+        pipe.next_subpage()
+        measured, other = meter.measure(pipe.process_ready)
+        if i < _WARMUP:
+            continue
+        worst[name] = max(worst.get(name, 0), measured)
+        failure = check(name, measured, other, budget_of(total))
+        if failure:
+            print(f"FAIL subpage {i - _WARMUP} {failure}")
+            failures += 1
+
+    for name, boxes in BUDGETS + ((name, total),):
+        print(f"{name}: worst {worst[name]} float boxes, budget {budget_of(boxes)}")
+    print(f"subpages: {subpages}, backend: {pipe.image.backend}, failures: {failures}")
+    return failures
+
+def main(argv):
+    subpages = _SUBPAGES
+    if argv[:1] == ['--subpages']:
+        subpages = int(argv[1])
+    if run(subpages):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 import math
+import time
 import uasyncio
 import micropython
 from array import array
@@ -10,9 +11,15 @@ from pinmap import I2C_CAMERA
 
 import mlx90640
 from mlx90640.calibration import NUM_ROWS, NUM_COLS, IMAGE_SIZE, TEMP_K
-from mlx90640.image import ChessPattern, InterleavedPattern
+from mlx90640.image import ChessPattern, InterleavedPattern, InterpolationPlan, merge_bad_pixels
+from mlx90640.scheduler import SubpageScheduler
+from mlx90640.recording import Recorder
+from mlx90640.temporal import TemporalFilter
+from mlx90640.assembler import FrameAssembler
 
 from config import Config
+from frames import FrameRing
+from perf import PROFILER
 from display import DISPLAY, Rect, PixMap, TextBox
 from display.gradient import WhiteHot
 from display.palette import *
@@ -20,11 +27,18 @@ from display.palette import *
 class CameraLoop:
     def __init__(self):
         self.camera = mlx90640.detect_camera(I2C_CAMERA)
-        self.camera.set_pattern(ChessPattern)
+        self.camera.configure(pattern=ChessPattern, subpage_mode=mlx90640.SUBPAGE_ALTERNATE)
+        self.camera.profiler = PROFILER
 
         self.update_event = Event()
+        self.scheduler = None
+        self.assembler = FrameAssembler()
+        self.frames = FrameRing(IMAGE_SIZE)
         self.state = None
         self.image = None
+        self.interp_plan = None
+        self.pixmap = None
+        self.recorder = None
 
         self.default = Config()
         try:
@@ -41,17 +55,42 @@ class CameraLoop:
         self.gradient = config.gradient()
         self.bad_pix = config.bad_pixels
         self.min_range = config.min_scale
+        self.upscale = config.upscale
         self.debug = config.debug
+        self.assembler.policy = config.update
+        self.record_path = config.record
+        self.temporal_filter = None
+        if config.filter is not None:
+            self.temporal_filter = TemporalFilter(
+                config.filter, frames=config.filter_frames, reset_k=config.filter_reset)
+        if self.image is not None:
+            self.image.set_filter(self.temporal_filter)
+        PROFILER.enable(config.debug)
 
     def set_refresh_rate(self, value):
         self.camera.refresh_rate = value
         self._refresh_period = math.ceil(1000/self.camera.refresh_rate)
+        if self.scheduler is None:
+            self.scheduler = SubpageScheduler(1000/self.camera.refresh_rate)
+        else:
+            self.scheduler.reset(1000/self.camera.refresh_rate)
 
     async def run(self):
         await uasyncio.sleep_ms(80 + 2 * int(self._refresh_period))
         print("setup camera...")
         self.camera.setup()
         self.image = self.camera.image
+        print(f"calibration from {self.camera.calib_source} took {self.camera.calib_time_ms} ms")
+
+        self.bad_pix = merge_bad_pixels(self.camera.calib, self.bad_pix)
+        self.interp_plan = InterpolationPlan(self.bad_pix)
+        self.image.set_exclusions(self.bad_pix)
+        self.image.set_filter(self.temporal_filter)
+        self.scheduler.configure(self.camera.read_control(), self.camera.read_status())
+        self.assembler.configure(self.scheduler.alternating)
+        if self.record_path is not None:
+            print(f"recording to {self.record_path}")
+            self.recorder = Recorder(self.record_path, self.camera)
 
         tasks = [
             self.display_images(),
@@ -65,9 +104,10 @@ class CameraLoop:
         display_size = DISPLAY.get_bounds()
 
         print("initialize display...")
-        pixmap = PixMap(NUM_ROWS, NUM_COLS, self.image.buf)
+        pixmap = self.pixmap = PixMap(NUM_ROWS, NUM_COLS, self.frames.back.buf)
         pixmap.update_rect(Rect(0, 0, *display_size))
         pixmap.draw_dummy(DISPLAY)
+        pixmap.set_upscale(self.upscale)
 
         for idx in self.bad_pix:
             row, col = divmod(idx, NUM_COLS)
@@ -114,13 +154,16 @@ class CameraLoop:
             await self.update_event.wait()
             self.update_event.clear()
 
-            # update max/min
-            limits = self.image.calc_limits(exclude_idx=self.bad_pix)
+            frame = self.frames.acquire()
+            if frame is None:
+                continue
+            start = PROFILER.start()
+            pixmap.buf = frame.buf
 
             # update temp scale min/max
-            min_temp = self._calc_temp(limits.min_idx)
-            max_temp = self._calc_temp(limits.max_idx)
-            # print(min_temp, max_temp)
+            limits = frame.limits
+            min_temp = frame.min_temp
+            max_temp = frame.max_temp
 
             # dynamic scaling
             boost = 1
@@ -137,8 +180,7 @@ class CameraLoop:
             pixmap.draw_reticle(DISPLAY, fg=COLOR_RETICLE)
 
             # update reticle
-            reticle_temp = self.calc_reticle_temperature()
-            text_reticle.text = f"{reticle_temp: 2.1f} °C"
+            text_reticle.text = f"{frame.reticle_temp: 2.1f} °C"
             text_reticle.draw(DISPLAY)
 
             # update scale text
@@ -157,43 +199,73 @@ class CameraLoop:
             text_max_scale.draw(DISPLAY)
 
             DISPLAY.update()
-
-    def _calc_temp(self, idx):
-        return self.image.calc_temperature(idx, self.state)
-
-    def _calc_temp_ext(self, idx):
-        return self.image.calc_temperature_ext(idx, self.state)
-
-    def calc_reticle_temperature(self):
-        reticle = (367, 368, 399, 400)
-        temp = sum(self._calc_temp_ext(idx) for idx in reticle)
-        return temp/4
-
-    async def wait_for_data(self):
-        await uasyncio.wait_for_ms(self._wait_inner(), int(self._refresh_period))
-
-    async def _wait_inner(self):
-        while not self.camera.has_data:
-            await uasyncio.sleep_ms(50)
+            PROFILER.stop('render', start)
 
     async def stream_images(self):
         print("start image read loop...")
-        sp = 0
-        while True:
-            await self.wait_for_data()
-            
-            self.camera.read_image(sp)
-
-            self.state = self.camera.read_state()
-            self.image = self.camera.process_image(sp, self.state)
-            self.image.interpolate_bad_pixels(self.bad_pix)
-            sp = int(not sp)
-
-            self.update_event.set()
-
-            await uasyncio.sleep_ms(int(self._refresh_period * 0.8))
+        camera = self.camera
+        scheduler = self.scheduler
+        assembler = self.assembler
+        state = self.state = mlx90640.CameraState()  # refilled every frame
+        try:
+            while True:
+                # sleep until the next subpage is due, then poll for it. this is
+                # inline rather than in a helper coroutine (or wait_for), which
+                # would allocate every frame
+                await uasyncio.sleep_ms(scheduler.wake_delay_ms())
+                deadline = time.ticks_add(time.ticks_ms(), scheduler.timeout_ms())
+                status = camera.read_status()
+                while not scheduler.poll(status):
+                    if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+                        raise uasyncio.TimeoutError
+                    await uasyncio.sleep_ms(scheduler.poll_ms)
+                    status = camera.read_status()
+                sp = status['last_subpage']
+
+                camera.read_image(sp, status=status)
+
+                camera.read_state(out=state)
+                if self.recorder is not None:
+                    start = PROFILER.start()
+                    self.recorder.write(camera, sp)
+                    PROFILER.stop('record', start)
+
+                image = self.image = camera.process_image(sp, state)
+                PROFILER.mark('subpage')
+                if assembler.add(camera.last_read, state):
+                    # bad pixels are interpolated from their neighbours, which
+                    # belong to the other subpage, so wait for it as well
+                    start = PROFILER.start()
+                    image.interpolate_bad_pixels(self.interp_plan)
+                    PROFILER.stop('interpolate', start)
+
+                    # hand the frame to display_images() without waiting for it
+                    start = PROFILER.start()
+                    self.frames.publish(image, assembler.state)
+                    PROFILER.stop('publish', start)
+                    PROFILER.mark('frame')
+                    self.update_event.set()
+
+                if self.debug:
+                    # collect while waiting for the next subpage, so pauses are timed
+                    PROFILER.collect()
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
 
     async def print_mem_usage(self):
         while True:
             await uasyncio.sleep(5)
             micropython.mem_info()
+            if self.pixmap is not None:
+                print(f"cells drawn last frame: {self.pixmap.cells_drawn}")
+            frames = self.frames
+            print(f"frames: {frames.published} published, {frames.overruns} overruns, {frames.dropped} dropped")
+            sched = self.scheduler
+            print(f"subpages: {sched.subpages} read, {sched.missed} missed, {sched.late} late, {sched.polls} polls")
+            assembler = self.assembler
+            print(f"assembled: {assembler.frames} complete frames, {assembler.repeats} repeated subpages")
+            print(f"subpage period: {sched.period_ms:.2f} ms, latency {sched.latency_us} us (max {sched.max_latency_us} us)")
+            if self.temporal_filter is not None:
+                print(f"temporal filter: {self.temporal_filter.resets} pixel resets")
+            PROFILER.print_report()
@@ -1,6 +1,8 @@
 import json
 
 from display.gradient import WhiteHot, BlackHot, Ironbow
+from mlx90640.temporal import FILTER_EMA, FILTER_BOX
+from mlx90640.assembler import ASSEMBLE_SUBPAGE, ASSEMBLE_FRAME
 
 _THERM_PALETTE = {
     'whitehot': WhiteHot,
@@ -8,13 +10,35 @@ _THERM_PALETTE = {
     'ironbow': Ironbow,
 }
 
+# modes that have been timed on the device. PixMap.set_upscale() also takes
+# 2, 4 and 'fit', time them with the draw_map_upscale_* stages of
+# bench/pipeline.py before adding them here
+_UPSCALE_MODES = (1,)
+
+_UPDATE_POLICY = {
+    'subpage': ASSEMBLE_SUBPAGE,
+    'frame': ASSEMBLE_FRAME,
+}
+
+_TEMPORAL_FILTER = {
+    'none': None,
+    'ema': FILTER_EMA,
+    'box': FILTER_BOX,
+}
+
 class Config:
     def __init__(self):
         self.refresh_rate = 4
         self.bad_pixels = ()
         self.gradient = Ironbow
         self.min_scale = 8
+        self.upscale = 1
         self.debug = False
+        self.update = ASSEMBLE_FRAME  # display update policy, see mlx90640.assembler
+        self.record = None  # path to record raw subpages to, see mlx90640.recording
+        self.filter = None  # temporal noise filter mode, see mlx90640.temporal
+        self.filter_frames = 4
+        self.filter_reset = 2.0  # kelvin
 
     def load(self, config_path):
         with open(config_path, 'rt') as cfg_file:
@@ -28,5 +52,23 @@ class Config:
             self.gradient = _THERM_PALETTE.get(cfg_data['gradient'], self.gradient)
         if 'min_scale' in cfg_data:
             self.min_scale = int(cfg_data['min_scale'])
+        if 'upscale' in cfg_data:
+            upscale = cfg_data['upscale']
+            if upscale != 'fit':
+                upscale = int(upscale)
+            if upscale in _UPSCALE_MODES:
+                self.upscale = upscale
+            else:
+                print(f"ignoring upscale {upscale}, should be one of {_UPSCALE_MODES}")
         if 'debug' in cfg_data:
             self.debug = bool(cfg_data['debug'])
+        if 'update' in cfg_data:
+            self.update = _UPDATE_POLICY.get(cfg_data['update'], self.update)
+        if 'filter' in cfg_data:
+            self.filter = _TEMPORAL_FILTER.get(cfg_data['filter'], self.filter)
+        if 'filter_frames' in cfg_data:
+            self.filter_frames = int(cfg_data['filter_frames'])
+        if 'filter_reset' in cfg_data:
+            self.filter_reset = float(cfg_data['filter_reset'])
+        if 'record' in cfg_data:
+            self.record = cfg_data['record'] or None
@@ -1,6 +1,8 @@
+from array import array
 from ucollections import namedtuple
 
 from display.driver import DISPLAY
+from display.upscale import BilinearUpscaler
 
 from display.palette import (
     COLOR_DEFAULT_BG,
@@ -41,9 +43,21 @@ class PixMap:
             raise ValueError(f"invalid buffer size for {width}x{height} PixMap: {len(buf)}")
 
         self.buf = buf
+        self.index_buf = bytearray(len(buf))  # quantized buf, indexes gradient pens
         self.draw_scale = 0 # size of element in pixels
         self.draw_rect = Rect(0, 0, 0, 0)
 
+        # what is currently on screen, for delta rendering
+        self.drawn_buf = bytearray(len(buf))
+        self._drawn_pens = None
+        self._repaint = True
+        self.cells_drawn = 0  # number of cells (or upscaled rectangles) drawn by the last draw_map()
+
+        # smooth rendering, see set_upscale()
+        self.upscale = 1
+        self._upscaler = None
+        self._upscale_pos = (0, 0)
+
     def update_rect(self, rect):
         self.draw_scale = min(rect.width/self.width, rect.height/self.height)
         self.square_size = int(round(self.draw_scale))
@@ -55,6 +69,44 @@ class PixMap:
         origin_y = (rect.height - draw_height)/2.0 + rect.y
         self.draw_rect = Rect(origin_x, origin_y, draw_width, draw_height)
 
+        # element positions along each axis
+        self._elem_x = array('h', (int(round(origin_x + i*self.draw_scale)) for i in range(self.width)))
+        self._elem_y = array('h', (int(round(origin_y + j*self.draw_scale)) for j in range(self.height)))
+        self._repaint = True
+        self.set_upscale(self.upscale)
+
+    def set_upscale(self, mode):
+        # mode is 1 for one square per element, 2 or 4 for a fixed scale factor
+        # or 'fit' to fill the draw rect, with bilinear interpolation between elements
+        self.upscale = mode
+        self._upscaler = None
+        self._repaint = True
+        if mode == 1:
+            return
+
+        fit_width = int(self.draw_rect.width)
+        fit_height = int(self.draw_rect.height)
+        if mode == 'fit':
+            out_width, out_height = fit_width, fit_height
+        else:
+            out_width = self.width * int(mode)
+            out_height = self.height * int(mode)
+            if out_width > fit_width or out_height > fit_height:
+                # a fixed scale that does not fit would draw over the rest of the display
+                out_width, out_height = fit_width, fit_height
+        if out_width <= 0 or out_height <= 0:
+            return  # no draw rect yet
+
+        self._upscaler = BilinearUpscaler(self.width, self.height, out_width, out_height)
+        self._upscale_pos = (
+            int(round(self.draw_rect.x + (self.draw_rect.width - out_width)/2.0)),
+            int(round(self.draw_rect.y + (self.draw_rect.height - out_height)/2.0)),
+        )
+
+    def repaint(self):
+        # the next draw_map() redraws every element
+        self._repaint = True
+
     def draw_dummy(self, display):
         dummy_colors = (COLOR_PIXMAP_0, COLOR_PIXMAP_1)
         square_size = int(round(self.draw_scale))
@@ -66,21 +118,61 @@ class PixMap:
                 x = int(round(self.draw_rect.x + i*self.draw_scale))
                 y = int(round(self.draw_rect.y + j*self.draw_scale))
                 display.rectangle(x, y, square_size, square_size)
+        self._repaint = True
 
     def get_elem_rect(self, i, j):
         x = int(round(self.draw_rect.x + i*self.draw_scale))
         y = int(round(self.draw_rect.y + j*self.draw_scale))
         return Rect(x, y, self.square_size, self.square_size)
 
-    def draw_map(self, display, gradient):
+    def draw_map(self, display, gradient, *, force=False):
+        # only elements whose pen index changed since the last draw are redrawn
+        # unless force is set, the gradient changed, or a repaint is pending
+        index_buf = self.index_buf
+        gradient.quantize(self.buf, index_buf)
+
+        pens = gradient.pens
+        if self._upscaler is not None:
+            self._draw_upscaled(display, pens)
+            return
+
+        drawn_buf = self.drawn_buf
+        full = force or self._repaint or pens is not self._drawn_pens
+
+        elem_x = self._elem_x
+        elem_y = self._elem_y
+        size = self.square_size
+        count = 0
         idx = 0
         for i in range(self.width):
+            x = elem_x[i]
             for j in range(self.height):
-                value = self.buf[idx]
+                value = index_buf[idx]
+                if full or value != drawn_buf[idx]:
+                    display.set_pen(pens[value])
+                    display.rectangle(x, elem_y[j], size, size)
+                    drawn_buf[idx] = value
+                    count += 1
                 idx += 1
-                
-                display.set_pen(gradient.get_color(value))
-                display.rectangle(*self.get_elem_rect(i, j))
+
+        self.cells_drawn = count
+        self._drawn_pens = pens
+        self._repaint = False
+
+    def _draw_upscaled(self, display, pens):
+        if self._repaint:
+            # clear anything outside of the upscaled image
+            display.set_pen(COLOR_DEFAULT_BG)
+            display.rectangle(*self.get_draw_bounds())
+        x, y = self._upscale_pos
+        self.cells_drawn = self._upscaler.draw(display, self.index_buf, pens, x, y)
+        self._drawn_pens = None  # drawn_buf no longer matches the screen
+        self._repaint = False
+
+    def get_draw_bounds(self):
+        x = int(round(self.draw_rect.x))
+        y = int(round(self.draw_rect.y))
+        return Rect(x, y, int(round(self.draw_rect.width)), int(round(self.draw_rect.height)))
 
     def draw_reticle(self, display, *, fg=COLOR_DEFAULT_FG, scale=1):
         display.set_pen(fg)
@@ -24,25 +24,16 @@ class Lerp:
         return x*self._slope + self._out0
 
 
-class WhiteHot:
-    def __init__(self, h_scale=(0, 1)):
-        self.h_scale = h_scale
-
-    @property
-    def h_scale(self):
-        return self._h_scale
-
-    @h_scale.setter
-    def h_scale(self, value):
-        self._h_scale = value
-        self._lerp = Lerp(value, (0, 255))
-
-    def get_color(self, h):
-        v = int(round(self._lerp(h)))
-        return DISPLAY.create_pen(v, v, v)
+class _BaseGradient:
+    # maps h values onto a table of pens
+    # subclasses provide _build_pens(), which is called once per class
+    _PENS = None
 
-class BlackHot:
     def __init__(self, h_scale=(0, 1)):
+        cls = type(self)
+        if cls._PENS is None:
+            cls._PENS = cls._build_pens()
+        self.pens = cls._PENS
         self.h_scale = h_scale
 
     @property
@@ -52,11 +43,34 @@ class BlackHot:
     @h_scale.setter
     def h_scale(self, value):
         self._h_scale = value
-        self._lerp = Lerp(value, (255, 0))
+        self._lerp = Lerp(value, (0, len(self.pens) - 1))
 
     def get_color(self, h):
-        v = int(round(self._lerp(h)))
-        return DISPLAY.create_pen(v, v, v)
+        return self.pens[int(round(self._lerp(h)))]
+
+    def quantize(self, buf, out):
+        # convert the h values in buf into indices into pens, written to out (a bytearray)
+        in0 = self._lerp._in0
+        slope = self._lerp._slope
+        top = len(self.pens) - 1
+        for idx in range(len(buf)):
+            x = (buf[idx] - in0)*slope
+            if x >= top:
+                out[idx] = top
+            elif x > 0:
+                out[idx] = int(x + 0.5)
+            else:
+                out[idx] = 0
+
+class WhiteHot(_BaseGradient):
+    @staticmethod
+    def _build_pens():
+        return array('B', (DISPLAY.create_pen(v, v, v) for v in range(256)))
+
+class BlackHot(_BaseGradient):
+    @staticmethod
+    def _build_pens():
+        return array('B', (DISPLAY.create_pen(v, v, v) for v in range(255, -1, -1)))
 
 def unpack_rgb(pack_bytes):
     palette = array('B')
@@ -68,22 +82,12 @@ def unpack_rgb(pack_bytes):
     return palette
 
 def load_palette_bin(bin_path):
-    palette = array('B')
     with open(bin_path, 'rb') as bin_file:
         return unpack_rgb(bin_file.read())
 
-class Ironbow:
-    _PALETTE = load_palette_bin('/display/ironbow.bin')
-    
-    @property
-    def h_scale(self):
-        return self._h_scale
-
-    @h_scale.setter
-    def h_scale(self, value):
-        self._h_scale = value
-        self._lerp = Lerp(value, (0, len(self._PALETTE) - 1))
-
-    def get_color(self, h):
-        return self._PALETTE[int(round(self._lerp(h)))]
+class Ironbow(_BaseGradient):
+    PALETTE_PATH = '/display/ironbow.bin'
 
+    @classmethod
+    def _build_pens(cls):
+        return load_palette_bin(cls.PALETTE_PATH)
@@ -0,0 +1,101 @@
+""" Bilinear upscaling of quantized pixel maps.
+
+Interpolation is done on a grid of at most MAX_SAMPLES samples per source
+element along each axis, and every sample is drawn as a block of the output,
+so the work per frame does not grow with the output size. Adjacent samples of
+the same pen are merged into one rectangle; with an RGB332 display many
+neighbouring gradient indices share a pen, so the runs are long.
+"""
+
+from array import array
+
+MAX_SAMPLES = const(2)
+
+_FRAC_BITS = const(8)
+_ONE = const(1 << 8)
+_ROUND = const(1 << 15)  # half of _ONE*_ONE
+
+def _axis_weights(src_size, out_size):
+    # for each output position, the lower source element and the
+    # fixed-point weight given to the element after it
+    base = array('B', (0 for k in range(out_size)))
+    frac = array('H', (0 for k in range(out_size)))
+    for k in range(out_size):
+        s = (k + 0.5)*src_size/out_size - 0.5
+        if s <= 0:
+            i, f = 0, 0
+        elif s >= src_size - 1:
+            i, f = src_size - 2, _ONE
+        else:
+            i = int(s)
+            f = int((s - i)*_ONE + 0.5)
+        base[k] = i
+        frac[k] = f
+    return base, frac
+
+def _block_edges(grid_size, out_size):
+    # output position of the start of every sample's block, and the end of the last one
+    return array('H', (k*out_size//grid_size for k in range(grid_size + 1)))
+
+class BilinearUpscaler:
+    # interpolates a buffer of pen indices laid out as PixMap elements
+    # (index = i*src_height + j) and streams it to the display a row of
+    # samples at a time
+    def __init__(self, src_width, src_height, out_width, out_height):
+        self.src_width = src_width
+        self.src_height = src_height
+        self.out_width = out_width
+        self.out_height = out_height
+
+        self.grid_width = min(out_width, src_width*MAX_SAMPLES)
+        self.grid_height = min(out_height, src_height*MAX_SAMPLES)
+        self._x0, self._fx = _axis_weights(src_width, self.grid_width)
+        self._y0, self._fy = _axis_weights(src_height, self.grid_height)
+        self._edge_x = _block_edges(self.grid_width, out_width)
+        self._edge_y = _block_edges(self.grid_height, out_height)
+
+        # vertically interpolated source row, scaled by _ONE
+        self._column = array('H', (0 for i in range(src_width)))
+
+    def draw(self, display, index_buf, pens, x, y):
+        # returns the number of rectangles drawn
+        src_width = self.src_width
+        src_height = self.src_height
+        grid_width = self.grid_width
+        x0, fx = self._x0, self._fx
+        y0, fy = self._y0, self._fy
+        edge_x = self._edge_x
+        edge_y = self._edge_y
+        column = self._column
+
+        rects = 0
+        for gy in range(self.grid_height):
+            # vertical pass
+            w1 = fy[gy]
+            w0 = _ONE - w1
+            idx = y0[gy]
+            for i in range(src_width):
+                column[i] = index_buf[idx]*w0 + index_buf[idx + 1]*w1
+                idx += src_height
+
+            # horizontal pass, emitting runs of the same pen
+            top = y + edge_y[gy]
+            height = edge_y[gy + 1] - edge_y[gy]
+            start = 0
+            run_pen = -1
+            for gx in range(grid_width):
+                i = x0[gx]
+                w1 = fx[gx]
+                pen = pens[(column[i]*(_ONE - w1) + column[i + 1]*w1 + _ROUND) >> (2*_FRAC_BITS)]
+                if pen != run_pen:
+                    if gx:
+                        display.set_pen(run_pen)
+                        display.rectangle(x + edge_x[start], top, edge_x[gx] - edge_x[start], height)
+                        rects += 1
+                    start = gx
+                    run_pen = pen
+            display.set_pen(run_pen)
+            display.rectangle(x + edge_x[start], top, edge_x[grid_width] - edge_x[start], height)
+            rects += 1
+
+        return rects
@@ -0,0 +1,88 @@
+""" Frame handoff between the camera loop and the display.
+"""
+
+from utils import array_filled
+from mlx90640 import CameraState
+from mlx90640.image import ImageLimits
+
+_RETICLE = (367, 368, 399, 400)
+
+class Frame:
+    def __init__(self, size):
+        self.buf = array_filled('f', size, 1.0)
+        self.seq = 0
+        self.state = CameraState()
+        self.limits = ImageLimits()
+        self.min_temp = 0.0
+        self.max_temp = 0.0
+        self.reticle_temp = 0.0
+
+        self._view = memoryview(self.buf)
+        self._source = None
+        self._source_view = None
+
+    def capture(self, image, state, seq):
+        # copy the compensated image and everything the display needs from it,
+        # so the display never has to touch the ProcessedImage itself.
+        # state and limits are copied as well, the camera refills its own
+        if image is not self._source:
+            self._source = image
+            self._source_view = memoryview(image.buf)
+        self._view[:] = self._source_view
+        self.seq = seq
+        self.state.copy_from(state)
+
+        limits = self.limits
+        limits.copy_from(image.calc_limits())
+        if limits.min_idx is not None:
+            self.min_temp = image.calc_temperature(limits.min_idx, state)
+            self.max_temp = image.calc_temperature(limits.max_idx, state)
+
+        temp = 0.0
+        for idx in _RETICLE:
+            temp += image.calc_temperature_ext(idx, state)
+        self.reticle_temp = temp/len(_RETICLE)
+
+class FrameRing:
+    # triple buffer: the producer fills the back slot and swaps it with the
+    # ready slot, the consumer swaps the ready slot with the one it is showing.
+    # neither side ever waits for the other.
+    def __init__(self, size, *, slots=3):
+        if slots < 3:
+            raise ValueError(f"FrameRing needs at least 3 slots: {slots}")
+        self.frames = [Frame(size) for i in range(slots)]
+        self._back = 0
+        self._ready = 1
+        self._front = 2
+        self._fresh = False  # ready slot has not been acquired yet
+
+        self.published = 0
+        self.overruns = 0  # publish() replaced a frame that was never acquired
+        self.dropped = 0  # frames skipped between two acquire() calls
+        self._last_seq = 0
+
+    @property
+    def back(self):
+        return self.frames[self._back]
+
+    def publish(self, image, state):
+        self.published += 1
+        self.frames[self._back].capture(image, state, self.published)
+        if self._fresh:
+            self.overruns += 1
+        self._back, self._ready = self._ready, self._back
+        self._fresh = True
+
+    def acquire(self):
+        # returns the latest frame, or None if nothing new was published.
+        # the frame stays valid until the next acquire()
+        if not self._fresh:
+            return None
+        self._front, self._ready = self._ready, self._front
+        self._fresh = False
+
+        frame = self.frames[self._front]
+        if self._last_seq:
+            self.dropped += frame.seq - self._last_seq - 1
+        self._last_seq = frame.seq
+        return frame
@@ -1,18 +1,33 @@
-from ucollections import namedtuple
+import time
 from mlx90640.regmap import (
     REGISTER_MAP,
     EEPROM_MAP,
+    STATUS_ADDRESS,
+    CONTROL_ADDRESS,
+    AUX_ADDRESS,
+    AUX_SIZE,
+    HOST_REGISTERS,
     RegisterMap,
     CameraInterface,
+    MemoryImage,
     REG_SIZE,
     EEPROM_ADDRESS,
     EEPROM_SIZE,
 )
-from mlx90640.calibration import CameraCalibration, TEMP_K
-from mlx90640.image import RawImage, ProcessedImage, Subpage, get_pattern_by_id
+from mlx90640.calibration import CameraCalibration, TEMP_K, eeprom_digest
+from mlx90640.image import RawImage, ProcessedImage, Subpage, get_subpage, get_pattern_by_id
 
 class CameraDetectError(Exception): pass
 
+class _NoProfiler:
+    # stands in for perf.Profiler until MLX90640.profiler is set
+    def start(self):
+        return None
+    def stop(self, name, start):
+        pass
+
+_NO_PROFILER = _NoProfiler()
+
 def detect_camera(i2c):
     """Detects the camera with the assumption that it is the only device on the I2C interface"""
     scan = i2c.scan()
@@ -39,26 +54,86 @@ class RefreshRate:
         )
         return value
 
-# container for momentary state needed for image compensation
-CameraState = namedtuple('CameraState', ('vdd', 'ta', 'ta_r', 'gain', 'gain_cp'))
+class CameraState:
+    # container for momentary state needed for image compensation
+    # mutable so that one instance can be refilled every frame, see read_state()
+    def __init__(self, vdd=0.0, ta=0.0, ta_r=0.0, gain=0.0, gain_cp=(0.0, 0.0)):
+        self.vdd = vdd
+        self.ta = ta
+        self.ta_r = ta_r
+        self.gain = gain
+        self.gain_cp = [gain_cp[0], gain_cp[1]]
+
+    def copy_from(self, other):
+        self.vdd = other.vdd
+        self.ta = other.ta
+        self.ta_r = other.ta_r
+        self.gain = other.gain
+        self.gain_cp[0] = other.gain_cp[0]
+        self.gain_cp[1] = other.gain_cp[1]
 
 class DataNotAvailableError(Exception): pass
 
+# subpage measurement modes, as (subpage_enable, subpage_repeat, repeat_select)
+SUBPAGE_ALTERNATE = (1, 0, 0)
+SUBPAGE_REPEAT_0  = (1, 1, 0)
+SUBPAGE_REPEAT_1  = (1, 1, 1)
+
+CALIB_CACHE_PATH = const('/calib.bin')
+
+# registers needed by read_state(), each range is read in one burst.
+# the control register is shadowed so it is not part of it
+STATE_RANGES = (
+    (AUX_ADDRESS, AUX_SIZE),
+)
+
 class MLX90640:
     def __init__(self, i2c, addr):
         self.iface = CameraInterface(i2c, addr)
-        self.registers = RegisterMap(self.iface, REGISTER_MAP)
-        self.eeprom = RegisterMap(self.iface, EEPROM_MAP, readonly=True)
+        self.registers = RegisterMap(self.iface, REGISTER_MAP, cached=HOST_REGISTERS)
+        self.eeprom_image = MemoryImage(EEPROM_ADDRESS, EEPROM_SIZE)
+        self.eeprom = RegisterMap(self.eeprom_image, EEPROM_MAP, readonly=True)
+        self.aux = None  # snapshot of the STATE_RANGES registers
         self.calib = None
         self.raw = None
         self.image = None
+        self.pattern = None  # last known read pattern
         self.last_read = None
+        self.profiler = _NO_PROFILER  # an object with start()/stop(), such as perf.PROFILER
+
+        # how the calibration was obtained ('cache' or 'eeprom') and how long it took
+        self.calib_source = None
+        self.calib_time_ms = None
 
-    def setup(self, *, calib=None, raw=None, image=None):
-        self.calib = calib or CameraCalibration(self.iface, self.eeprom)
+    def setup(self, *, calib=None, raw=None, image=None, calib_cache=CALIB_CACHE_PATH):
+        # calib_cache is the path of the calibration cache file, or None to disable caching
+        self.calib = calib or self.load_calibration(calib_cache)
         self.raw = raw or RawImage()
         self.image = image or ProcessedImage(self.calib)
 
+    def load_calibration(self, cache_path=None):
+        start = time.ticks_ms()
+        self.eeprom_image.load(self.iface)
+        digest = eeprom_digest(self.eeprom_image)
+
+        calib = None
+        if cache_path is not None:
+            calib = CameraCalibration.load(cache_path, self.eeprom_image, digest)
+
+        if calib is not None:
+            self.calib_source = 'cache'
+        else:
+            calib = CameraCalibration(self.eeprom_image, self.eeprom)
+            self.calib_source = 'eeprom'
+        self.calib_time_ms = time.ticks_diff(time.ticks_ms(), start)
+
+        if cache_path is not None and self.calib_source == 'eeprom':
+            try:
+                calib.save(cache_path, digest)
+            except OSError as err:
+                print(f"failed to write calibration cache: {err}")
+        return calib
+
     @property
     def refresh_rate(self):
         return RefreshRate.get_freq(self.registers['refresh_rate'])
@@ -67,14 +142,38 @@ class MLX90640:
         self.registers['refresh_rate'] = RefreshRate.from_freq(freq)
 
     def get_pattern(self):
-        return get_pattern_by_id(self.registers['read_pattern'])
+        self.pattern = get_pattern_by_id(self.registers['read_pattern'])
+        return self.pattern
     def set_pattern(self, pat):
         self.registers['read_pattern'] = pat.pattern_id
-
-    def read_vdd(self):
+        self.pattern = pat
+
+    # the read_* methods below read from the device registers, or from
+    # regs if given (such as a snapshot of STATE_RANGES)
+
+    def configure(self, *, refresh_rate=None, pattern=None, adc_resolution=None, subpage_mode=None, verify=False):
+        # apply several settings with one write per register
+        # subpage_mode should be one of the SUBPAGE_* constants
+        with self.registers.transaction(verify=verify) as txn:
+            if refresh_rate is not None:
+                txn['refresh_rate'] = RefreshRate.from_freq(refresh_rate)
+            if pattern is not None:
+                txn['read_pattern'] = pattern.pattern_id
+            if adc_resolution is not None:
+                txn['adc_resolution'] = adc_resolution
+            if subpage_mode is not None:
+                enable, repeat, select = subpage_mode
+                txn['subpage_enable'] = enable
+                txn['subpage_repeat'] = repeat
+                txn['repeat_select'] = select
+        if pattern is not None:
+            self.pattern = pattern
+
+    def read_vdd(self, regs=None):
         # supply voltage calculation (delta Vdd)
         # type: (self) -> float
-        vdd_pix = self.registers['vdd_pix'] * self._adc_res_corr()
+        regs = regs if regs is not None else self.registers
+        vdd_pix = regs['vdd_pix'] * self._adc_res_corr()
         return float(vdd_pix - self.calib.vdd_25)/self.calib.k_vdd
 
     def _adc_res_corr(self):
@@ -82,14 +181,18 @@ class MLX90640:
         res_exp = self.calib.res_ee - self.registers['adc_resolution']
         return 1 << res_exp
 
-    def read_ta(self):
+    def read_ta(self, regs=None, vdd=None):
         # ambient temperature calculation (delta Ta in degC)
+        # vdd may be a read_vdd() result from the same registers
         # type: (self) -> float
-        v_ptat = self.registers['ta_ptat']
-        v_be = self.registers['ta_vbe']
+        regs = regs if regs is not None else self.registers
+        if vdd is None:
+            vdd = self.read_vdd(regs)
+        v_ptat = regs['ta_ptat']
+        v_be = regs['ta_vbe']
         v_ptat_art = v_ptat/(v_ptat*self.calib.alpha_ptat + v_be) * 262144
 
-        v_ta = v_ptat_art/(1.0 + self.calib.kv_ptat*self.read_vdd() - self.calib.ptat_25)
+        v_ta = v_ptat_art/(1.0 + self.calib.kv_ptat*vdd - self.calib.ptat_25)
 
         # print('v_ptat: ', v_ptat)
         # print('v_be:', v_be)
@@ -97,18 +200,39 @@ class MLX90640:
 
         return v_ta/self.calib.kt_ptat
 
-    def read_gain(self):
+    def read_gain(self, regs=None):
         # gain calculation
         # type: (self) -> float
-        return self.calib.gain / self.registers['gain']
+        regs = regs if regs is not None else self.registers
+        return self.calib.gain / regs['gain']
+
+    def read_aux(self):
+        # burst read of the registers behind CameraState
+        if self.aux is None:
+            self.aux = self.registers.snapshot(STATE_RANGES)
+        else:
+            self.aux.load()
+        return self.aux
+
+    def aux_buf(self):
+        # raw words from AUX_ADDRESS as last read by read_aux(), big-endian
+        regs = self.aux or self.read_aux()
+        for image in regs.iface.images:
+            if image.address == AUX_ADDRESS:
+                return image.buf
 
     # tr - temperature of reflected environment
-    def read_state(self, *, tr=None):
-        gain = self.read_gain()
-        cp_sp_0 = gain * self.registers['cp_sp_0']
-        cp_sp_1 = gain * self.registers['cp_sp_1']
+    # out - a CameraState to fill in rather than making a new one
+    def read_state(self, *, tr=None, out=None):
+        start = self.profiler.start()
+        regs = self.read_aux()
+        vdd = self.read_vdd(regs)
+
+        gain = self.read_gain(regs)
+        cp_sp_0 = gain * regs['cp_sp_0']
+        cp_sp_1 = gain * regs['cp_sp_1']
 
-        ta = self.read_ta()
+        ta = self.read_ta(regs, vdd)
 
         ta_abs = ta + 25
         if self.calib.emissivity == 1:
@@ -119,13 +243,15 @@ class MLX90640:
             tr_k4 = (tr + TEMP_K)**4
             ta_r = tr_k4 - (tr_k4 - ta_k4)/self.calib.emissivity
 
-        return CameraState(
-            vdd = self.read_vdd(),
-            ta = ta,
-            ta_r = ta_r,
-            gain = gain,
-            gain_cp = (cp_sp_0, cp_sp_1),
-        )
+        state = out if out is not None else CameraState()
+        state.vdd = vdd
+        state.ta = ta
+        state.ta_r = ta_r
+        state.gain = gain
+        state.gain_cp[0] = cp_sp_0
+        state.gain_cp[1] = cp_sp_1
+        self.profiler.stop('read_state', start)
+        return state
 
     @property
     def has_data(self):
@@ -135,19 +261,33 @@ class MLX90640:
     def last_subpage(self):
         return self.registers['last_subpage']
 
-    def read_image(self, sp_id = None):
-        if not self.has_data:
+    def read_status(self):
+        # status register fields: last_subpage, data_available, overwrite_enable
+        # the result is reused by the next read_status()
+        return self.registers.read_struct(STATUS_ADDRESS)
+
+    def read_control(self):
+        return self.registers.read_struct(CONTROL_ADDRESS)
+
+    def read_image(self, sp_id = None, *, status = None):
+        # status may be a recent read_status() result, saving a register read
+        if status is None:
+            status = self.read_status()
+        if not status['data_available']:
             raise DataNotAvailableError
         
         if sp_id is None:
-            sp_id = self.last_subpage
+            sp_id = status['last_subpage']
 
-        subpage = Subpage(self.get_pattern(), sp_id)
+        pattern = self.pattern or self.get_pattern()
+        subpage = get_subpage(pattern, sp_id)
         self.last_read = subpage
 
         # print(f"read SP {subpage.id}")
-        self.raw.read(self.iface, subpage.sp_range())
+        start = self.profiler.start()
+        self.raw.read(self.iface, subpage)
         self.registers['data_available'] = 0
+        self.profiler.stop('read_image', start)
         return self.raw
 
     def process_image(self, sp_id = None, state = None):
@@ -155,14 +295,15 @@ class MLX90640:
             raise DataNotAvailableError
 
         subpage = self.last_read
-        if sp_id is not None:
-            subpage.id = sp_id
+        if sp_id is not None and sp_id != subpage.id:
+            subpage = get_subpage(subpage.pattern, sp_id)
 
         state = state or self.read_state()
 
         # print(f"process SP {subpage.id}")
-        raw_data = ((idx, self.raw[idx]) for idx in subpage.sp_range())
-        self.image.update(raw_data, subpage, state)
+        start = self.profiler.start()
+        self.image.update(self.raw.pix, subpage, state)
+        self.profiler.stop('process_image', start)
         return self.image
 
     # def dump_eeprom(self):
@@ -0,0 +1,64 @@
+""" Assembly of subpages into complete frames.
+
+The sensor measures one subpage (half of the pixels) per refresh period. A
+FrameAssembler follows the subpages of the frame being built up and tells
+the reader when to hand the image on: after every subpage, or only once
+both halves have been read since the last complete frame.
+"""
+
+from mlx90640 import CameraState
+
+ASSEMBLE_SUBPAGE = const(0)  # update on every subpage, half a frame of lower latency
+ASSEMBLE_FRAME = const(1)    # update on complete frames, half the downstream work
+
+class FrameAssembler:
+    def __init__(self, policy=ASSEMBLE_FRAME):
+        self.policy = policy
+        self.alternating = True  # both subpages are measured, see configure()
+
+        # the state each subpage was compensated with
+        self.states = (CameraState(), CameraState())
+        self.state = self.states[0]  # of the latest subpage
+        self._fresh = [False, False]
+        self._pattern = None
+
+        # counters
+        self.subpages = 0
+        self.frames = 0    # complete frames
+        self.repeats = 0   # subpages read again before the frame was complete
+
+    def configure(self, alternating):
+        # alternating as worked out by SubpageScheduler.configure(), when it is
+        # False every subpage is a complete frame
+        self.alternating = alternating
+        self.reset()
+
+    def reset(self):
+        self._fresh[0] = self._fresh[1] = False
+        self._pattern = None
+
+    @property
+    def pending(self):
+        # subpages of the current frame read so far
+        return self._fresh[0] + self._fresh[1]
+
+    def add(self, subpage, state):
+        # records a processed subpage, returns True if the image should be
+        # handed on now under the policy
+        if subpage.pattern is not self._pattern:
+            self.reset()
+            self._pattern = subpage.pattern
+
+        sp_id = subpage.id
+        self.subpages += 1
+        if self._fresh[sp_id]:
+            self.repeats += 1
+        self._fresh[sp_id] = True
+        self.state = self.states[sp_id]
+        self.state.copy_from(state)
+
+        complete = not self.alternating or (self._fresh[0] and self._fresh[1])
+        if complete:
+            self._fresh[0] = self._fresh[1] = False
+            self.frames += 1
+        return complete or self.policy == ASSEMBLE_SUBPAGE
@@ -1,8 +1,10 @@
+import struct
 from array import array
+from uhashlib import sha256
 from utils import (
-    Struct, 
     StructProto,
     field_desc,
+    array_filled,
 )
 from mlx90640.regmap import REG_SIZE
 
@@ -23,26 +25,23 @@ CC_PROTO = StructProto((
     field_desc('3', 4, 12, signed=True),
 ))
 
-def _read_cc_iter(iface, base, size):
-    buf = bytearray(REG_SIZE)
-    struct = Struct(buf, CC_PROTO)
-    for addr_off in range(size // 4):
-        cc_addr = base + addr_off
-        iface.read_into(cc_addr, buf)
-        yield struct['0']
-        yield struct['1']
-        yield struct['2']
-        yield struct['3']
-
-def read_occ_rows(iface):
-    return _read_cc_iter(iface, OCC_ROWS_ADDRESS, NUM_ROWS)
-def read_occ_cols(iface):
-    return _read_cc_iter(iface, OCC_COLS_ADDRESS, NUM_COLS)
-
-def read_acc_rows(iface):
-    return _read_cc_iter(iface, ACC_ROWS_ADDRESS, NUM_ROWS)
-def read_acc_cols(iface):
-    return _read_cc_iter(iface, ACC_COLS_ADDRESS, NUM_COLS)
+def _read_cc(eeprom_image, base, size):
+    # each word holds four signed nibbles, the lowest first
+    words = eeprom_image.view(base, size // 4)
+    table = array_filled('b', size)
+    for nibble in range(4):
+        CC_PROTO.decode(str(nibble), words, table, nibble, 4)
+    return table
+
+def read_occ_rows(eeprom_image):
+    return _read_cc(eeprom_image, OCC_ROWS_ADDRESS, NUM_ROWS)
+def read_occ_cols(eeprom_image):
+    return _read_cc(eeprom_image, OCC_COLS_ADDRESS, NUM_COLS)
+
+def read_acc_rows(eeprom_image):
+    return _read_cc(eeprom_image, ACC_ROWS_ADDRESS, NUM_ROWS)
+def read_acc_cols(eeprom_image):
+    return _read_cc(eeprom_image, ACC_COLS_ADDRESS, NUM_COLS)
 
 PIX_CALIB_PROTO = StructProto((
     field_desc('offset',  6, 10, signed=True),
@@ -55,36 +54,106 @@ PIX_CALIB_ADDRESS = const(0x2440)
 
 
 class PixelCalibrationData:
-    def __init__(self, iface):
+    def __init__(self, eeprom_image, failed=None):
         pix_count = NUM_ROWS * NUM_COLS
-        self._data = bytearray(pix_count * REG_SIZE)
+        self._data = eeprom_image.view(PIX_CALIB_ADDRESS, pix_count)
+        if failed is not None:
+            self.failed = tuple(failed)
+            return
 
         failed = []
-        buf = bytearray(REG_SIZE)
+        data = self._data
         for idx in range(pix_count):
             offset = idx * REG_SIZE
-            iface.read_into(PIX_CALIB_ADDRESS + offset, buf)
-            if buf != bytes(REG_SIZE):
-                self._data[offset:offset+REG_SIZE] = buf
-            else:
+            if not (data[offset] or data[offset+1]):
                 failed.append(idx)
         self.failed = tuple(failed)
 
     def __len__(self):
         return len(self._data)//REG_SIZE
-    def __getitem__(self, idx):
-        offset = idx * REG_SIZE
-        return Struct(self._data[offset:offset+REG_SIZE], PIX_CALIB_PROTO)
-    def __iter__(self):
-        for idx in range(len(self)):
-            yield self[idx]
+
+    def decode(self, name):
+        # one field of PIX_CALIB_PROTO for every pixel, as an array
+        return PIX_CALIB_PROTO.decode(name, self._data, array_filled('b', len(self)))
 
 TEMP_K = const(273.15)
 
+def eeprom_digest(eeprom_image):
+    return sha256(eeprom_image.buf).digest()
+
+## Calibration cache file
+
+_CACHE_MAGIC = const(b'MLXC')
+_CACHE_VERSION = const(2)
+
+# magic, version, use_tgc, emissivity, EEPROM digest
+_CACHE_HEADER_FMT = const('>4sBBd32s')
+
+# (attribute, struct format) of the scalar coefficients, in file order
+_CACHE_SCALARS = (
+    ('k_vdd',       'i'),
+    ('vdd_25',      'i'),
+    ('res_ee',      'i'),
+    ('kv_ptat',     'd'),
+    ('kt_ptat',     'd'),
+    ('ptat_25',     'i'),
+    ('alpha_ptat',  'd'),
+    ('gain',        'i'),
+    ('kta_scale_1', 'i'),
+    ('kta_scale_2', 'i'),
+    ('kv_scale',    'i'),
+    ('kv_avg',      '4d'),
+    ('ksta',        'd'),
+    ('il_chess_c1', 'd'),
+    ('il_chess_c2', 'd'),
+    ('il_chess_c3', 'd'),
+    ('drift',       'd'),
+    ('ksto_scale',  'i'),
+    ('ksto',        '4d'),
+    ('ct',          '4i'),
+    ('alpha_ext',   '4d'),
+)
+
+# only present when use_tgc is set
+_CACHE_SCALARS_TGC = (
+    ('tgc',          'd'),
+    ('pix_os_cp',    '2i'),
+    ('kta_cp',       'd'),
+    ('kv_cp',        'd'),
+    ('pix_alpha_cp', '2d'),
+)
+
+# per-pixel tables, stored in native byte order
+_CACHE_ARRAYS = (
+    ('pix_os_ref', 'h'),
+    ('pix_kta',    'f'),
+    ('pix_kv',     'f'),
+    ('pix_alpha',  'f'),
+    ('il_offset',  'f'),
+)
+
+class CacheFormatError(Exception): pass
+
+def _read_exact(cache_file, size):
+    data = cache_file.read(size)
+    if len(data) != size:
+        raise CacheFormatError("unexpected end of file")
+    return data
+
 class CameraCalibration:
-    def __init__(self, iface, eeprom, *, emissivity=1, use_tgc=False):
+    def __init__(self, eeprom_image=None, eeprom=None, *, emissivity=1, use_tgc=False):
         self.emissivity = emissivity
 
+        # tgc only available for device type 'C'
+        self.use_tgc = use_tgc
+
+        # left empty when restoring from a cache file
+        if eeprom is not None:
+            self._calc_coefficients(eeprom_image, eeprom)
+
+    def _calc_coefficients(self, eeprom_image, eeprom):
+        use_tgc = self.use_tgc
+
         # restore VDD sensor parameters
         self.k_vdd = eeprom['k_vdd'] * 32
         self.vdd_25 = (eeprom['vdd_25'] - 256) * 32 - 8192
@@ -102,9 +171,10 @@ class CameraCalibration:
         self.gain = eeprom['gain']
 
         # pixel calibration data
-        self.pix_data = PixelCalibrationData(iface)
-        self.pix_os_ref = array('h', self._calc_pix_os_ref(iface, eeprom))
-        self.outliers = tuple(idx for idx, data in enumerate(self.pix_data) if data['outlier'])
+        self.pix_data = PixelCalibrationData(eeprom_image)
+        self.pix_os_ref = array('h', self._calc_pix_os_ref(eeprom_image, eeprom))
+        outlier = self.pix_data.decode('outlier')
+        self.outliers = tuple(idx for idx in range(len(outlier)) if outlier[idx])
 
         # IR data compensation
         self.kta_scale_1 = 1 << (eeprom['kta_scale_1'] + 8)
@@ -117,12 +187,9 @@ class CameraCalibration:
             (eeprom['kv_avg_re_ce']/self.kv_scale, eeprom['kv_avg_re_co']/self.kv_scale),
             (eeprom['kv_avg_ro_ce']/self.kv_scale, eeprom['kv_avg_ro_co']/self.kv_scale),
         )
+        self.pix_kv = array('f', self._calc_pix_kv())
         
         # IR gradient compensation
-
-        # tgc only available for device type 'C'
-        self.use_tgc = use_tgc
-
         if use_tgc:
             self.tgc = eeprom['tgc'] / 32.0 if use_tgc else False
 
@@ -134,7 +201,7 @@ class CameraCalibration:
             self.kv_cp = eeprom['kv_cp'] / self.kv_scale
 
         # sensitivity normalization
-        self.pix_alpha = array('f', self._calc_pix_alpha_ref(iface, eeprom))
+        self.pix_alpha = array('f', self._calc_pix_alpha_ref(eeprom_image, eeprom))
         self.ksta = eeprom['ksta'] / 8192.0
 
         if use_tgc:
@@ -173,14 +240,91 @@ class CameraCalibration:
         alpha_4 = alpha_3*(1.0 + ksto3*(ct4 - ct3))
         self.alpha_ext = (alpha_1, alpha_2, alpha_3, alpha_4)
 
-    def _calc_pix_os_ref(self, iface, eeprom):
+    ## Cache file
+
+    @classmethod
+    def load(cls, cache_path, eeprom_image, digest, *, emissivity=1, use_tgc=False):
+        # returns None if the cache is missing or was made from a different EEPROM
+        calib = cls(emissivity=emissivity, use_tgc=use_tgc)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                if not calib._read_cache(cache_file, eeprom_image, digest):
+                    return None
+        except (OSError, ValueError, CacheFormatError):
+            return None
+        return calib
+
+    def save(self, cache_path, digest):
+        with open(cache_path, 'wb') as cache_file:
+            cache_file.write(struct.pack(
+                _CACHE_HEADER_FMT, _CACHE_MAGIC, _CACHE_VERSION,
+                int(self.use_tgc), self.emissivity, digest,
+            ))
+
+            for name, fmt in self._cache_scalars():
+                value = getattr(self, name)
+                if name == 'kv_avg':
+                    value = value[0] + value[1]
+                if not isinstance(value, tuple):
+                    value = (value,)
+                cache_file.write(struct.pack('>' + fmt, *value))
+
+            for indices in (self.pix_data.failed, self.outliers):
+                cache_file.write(struct.pack('>H', len(indices)))
+                cache_file.write(array('H', indices))
+
+            for name, _ in _CACHE_ARRAYS:
+                cache_file.write(getattr(self, name))
+
+    def _cache_scalars(self):
+        if self.use_tgc:
+            return _CACHE_SCALARS + _CACHE_SCALARS_TGC
+        return _CACHE_SCALARS
+
+    def _read_cache(self, cache_file, eeprom_image, digest):
+        header = _read_exact(cache_file, struct.calcsize(_CACHE_HEADER_FMT))
+        magic, version, use_tgc, emissivity, cache_digest = struct.unpack(_CACHE_HEADER_FMT, header)
+        if magic != _CACHE_MAGIC or version != _CACHE_VERSION:
+            return False
+        if cache_digest != digest:
+            return False
+        if bool(use_tgc) != bool(self.use_tgc) or emissivity != self.emissivity:
+            return False
+
+        for name, fmt in self._cache_scalars():
+            fmt = '>' + fmt
+            value = struct.unpack(fmt, _read_exact(cache_file, struct.calcsize(fmt)))
+            setattr(self, name, value[0] if len(value) == 1 else value)
+        self.kv_avg = (self.kv_avg[0:2], self.kv_avg[2:4])
+
+        index_lists = []
+        for _ in range(2):
+            count, = struct.unpack('>H', _read_exact(cache_file, 2))
+            indices = array_filled('H', count)
+            if count > 0 and cache_file.readinto(indices) != count * 2:
+                raise CacheFormatError("unexpected end of file")
+            index_lists.append(tuple(indices))
+        failed, self.outliers = index_lists
+        self.pix_data = PixelCalibrationData(eeprom_image, failed)
+
+        for name, typecode in _CACHE_ARRAYS:
+            table = array_filled(typecode, IMAGE_SIZE)
+            if cache_file.readinto(table) != IMAGE_SIZE * struct.calcsize(typecode):
+                raise CacheFormatError("unexpected end of file")
+            setattr(self, name, table)
+        return True
+
+    ## Coefficient calculation
+
+    def _calc_pix_os_ref(self, eeprom_image, eeprom):
         offset_avg = eeprom['pix_os_average']
         occ_scale_row = 1 << eeprom['scale_occ_row']
         occ_scale_col = 1 << eeprom['scale_occ_col']
         occ_scale_rem = 1 << eeprom['scale_occ_rem']
 
-        occ_rows = tuple(read_occ_rows(iface))
-        occ_cols = tuple(read_occ_cols(iface))
+        occ_rows = read_occ_rows(eeprom_image)
+        occ_cols = read_occ_cols(eeprom_image)
+        pix_offset = self.pix_data.decode('offset')
 
         for row in range(NUM_ROWS):
             for col in range(NUM_COLS):
@@ -189,18 +333,19 @@ class CameraCalibration:
                     offset_avg
                     + occ_rows[row] * occ_scale_row
                     + occ_cols[col] * occ_scale_col
-                    + self.pix_data[idx]['offset'] * occ_scale_rem
+                    + pix_offset[idx] * occ_scale_rem
                 )
 
-    def _calc_pix_alpha_ref(self, iface, eeprom):
+    def _calc_pix_alpha_ref(self, eeprom_image, eeprom):
         alpha_ref = eeprom['pix_sensitivity_average']
         alpha_scale = 1 << (eeprom['alpha_scale'] + 30)
         acc_scale_row = 1 << eeprom['scale_acc_row']
         acc_scale_col = 1 << eeprom['scale_acc_col']
         acc_scale_rem = 1 << eeprom['scale_acc_rem']
 
-        acc_rows = tuple(read_acc_rows(iface))
-        acc_cols = tuple(read_acc_cols(iface))
+        acc_rows = read_acc_rows(eeprom_image)
+        acc_cols = read_acc_cols(eeprom_image)
+        pix_alpha = self.pix_data.decode('alpha')
 
         for row in range(NUM_ROWS):
             for col in range(NUM_COLS):
@@ -209,7 +354,7 @@ class CameraCalibration:
                     alpha_ref
                     + acc_rows[row] * acc_scale_row
                     + acc_cols[col] * acc_scale_col
-                    + self.pix_data[idx]['alpha'] * acc_scale_rem
+                    + pix_alpha[idx] * acc_scale_rem
                 ) / alpha_scale
 
     def _calc_pix_kta(self, eeprom):
@@ -218,14 +363,21 @@ class CameraCalibration:
             (eeprom['kta_avg_re_ce'], eeprom['kta_avg_re_co']),
             (eeprom['kta_avg_ro_ce'], eeprom['kta_avg_ro_co']),
         )
+        pix_kta = self.pix_data.decode('kta')
 
         for row in range(NUM_ROWS):
             for col in range(NUM_COLS):
                 idx = row * NUM_COLS + col
-                kta_ee = self.pix_data[idx]['kta']
+                kta_ee = pix_kta[idx]
                 kta_rc = kta_avg[row % 2][col % 2]
                 yield (kta_rc + kta_ee * self.kta_scale_2)/self.kta_scale_1
 
+    def _calc_pix_kv(self):
+        for row in range(NUM_ROWS):
+            kv_row = self.kv_avg[row % 2]
+            for col in range(NUM_COLS):
+                yield kv_row[col % 2]
+
     def _calc_il_offset(self):
         for idx in range(NUM_ROWS*NUM_COLS):
             il_pattern = idx//32 - (idx//64)*2
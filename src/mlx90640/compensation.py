@@ -0,0 +1,364 @@
+""" Per-frame pixel compensation kernels.
+
+A kernel fills the v_ir, alpha and buf planes of a ProcessedImage for the
+pixels of one subpage, given the raw frame and the momentary CameraState.
+As a side effect it finds the min/max of the updated pixels, skipping those
+flagged in the image's exclusion bitmap.
+"""
+
+import sys
+import math
+from mlx90640.calibration import NUM_COLS, IMAGE_SIZE, TEMP_K
+
+# optional array backend: ulab on device, numpy on the host
+try:
+    from ulab import numpy as np
+except ImportError:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+
+_INF = float('inf')
+
+def scan_limits(buf, indices, exclude, limits):
+    # find min/max of buf over indices, limits is filled with
+    # [min_h, max_h, min_idx, max_idx] (indices are None if nothing was found)
+    min_h, max_h = _INF, -_INF
+    min_idx = max_idx = None
+    for idx in indices:
+        if exclude[idx]:
+            continue
+        h = buf[idx]
+        if h < min_h:
+            min_h, min_idx = h, idx
+        if h > max_h:
+            max_h, max_idx = h, idx
+    limits[0] = min_h
+    limits[1] = max_h
+    limits[2] = min_idx
+    limits[3] = max_idx
+
+def calc_os_cp(calib, sp_id, interleaved, state):
+    # compensated offset of the subpage's compensation pixel
+    pix_os_cp = calib.pix_os_cp[sp_id]
+    if interleaved:
+        pix_os_cp += calib.il_chess_c1
+    return state.gain_cp[sp_id] - pix_os_cp*(1 + calib.kta_cp*state.ta)*(1 + calib.kv_cp*state.vdd)
+
+
+def scalar_temperature_map(calib, image, state, out, ext, indices):
+    # per-pixel To with the shared terms hoisted out of the loop
+    sqrt = math.sqrt
+    v_ir_plane = image.v_ir
+    alpha_plane = image.alpha
+    ta_r = state.ta_r
+    drift = calib.drift
+    ksto_1 = calib.ksto[1]
+    k_to = 1 - TEMP_K*ksto_1
+    offset_k = TEMP_K - drift
+    if indices is None:
+        indices = range(IMAGE_SIZE)
+
+    if not ext:
+        for idx in indices:
+            v_ir = v_ir_plane[idx]
+            alpha = alpha_plane[idx]
+            alpha_3 = alpha*alpha*alpha
+            s_x = sqrt(sqrt(v_ir*alpha_3 + ta_r*alpha_3*alpha))*ksto_1
+            out[idx] = sqrt(sqrt(v_ir/(alpha*k_to + s_x) + ta_r)) - offset_k
+        return
+
+    ct_0, ct_1, ct_2, ct_3 = calib.ct
+    ksto_0, _, ksto_2, ksto_3 = calib.ksto
+    alpha_ext_0, alpha_ext_1, alpha_ext_2, alpha_ext_3 = calib.alpha_ext
+    for idx in indices:
+        v_ir = v_ir_plane[idx]
+        alpha = alpha_plane[idx]
+        alpha_3 = alpha*alpha*alpha
+        s_x = sqrt(sqrt(v_ir*alpha_3 + ta_r*alpha_3*alpha))*ksto_1
+        to = sqrt(sqrt(v_ir/(alpha*k_to + s_x) + ta_r)) - offset_k
+
+        # extended range band
+        if to >= ct_3:
+            k = alpha*alpha_ext_3*(1 + ksto_3*(to - ct_3))
+        elif to >= ct_2:
+            k = alpha*alpha_ext_2*(1 + ksto_2*(to - ct_2))
+        elif to >= ct_1:
+            k = alpha*alpha_ext_1*(1 + ksto_1*(to - ct_1))
+        elif to >= ct_0:
+            k = alpha*alpha_ext_0*(1 + ksto_0*(to - ct_0))
+        else:
+            out[idx] = ct_0
+            continue
+        out[idx] = sqrt(sqrt(v_ir/k + ta_r)) - offset_k
+
+
+class ReferenceKernel:
+    # straightforward per-pixel implementation, kept for comparison
+    def __init__(self, calib):
+        self.calib = calib
+
+    def temperature_map(self, image, state, out, ext, indices, sp_id, interleaved):
+        scalar_temperature_map(self.calib, image, state, out, ext, indices)
+
+    def update(self, image, raw, indices, sp_id, interleaved, state, limits):
+        if self.calib.use_tgc:
+            pix_os_cp = calc_os_cp(self.calib, sp_id, interleaved, state)
+            pix_alpha_cp = self.calib.pix_alpha_cp[sp_id]
+
+        for idx in indices:
+            ## IR data compensation - offset, Vdd, and Ta
+            kta = self.calib.pix_kta[idx]
+
+            row, col = divmod(idx, NUM_COLS)
+            kv = self.calib.kv_avg[row % 2][col % 2]
+
+            offset = self.calib.pix_os_ref[idx]
+            offset *= (1 + kta*state.ta)*(1 + kv*state.vdd)
+
+            v_os = raw[idx]*state.gain - offset
+            if interleaved:
+                v_os += self.calib.il_offset[idx]
+            v_ir = v_os / self.calib.emissivity
+
+            ## IR data gradient compensation
+            if self.calib.use_tgc:
+                v_ir -= self.calib.tgc*pix_os_cp
+
+            # preserve v_ir and alpha for temperature calculations
+            image.v_ir[idx] = v_ir
+
+            ## sensitivity normalization
+            alpha = self.calib.pix_alpha[idx]
+            if self.calib.use_tgc:
+                alpha -= self.calib.tgc*pix_alpha_cp
+            alpha *= (1 + self.calib.ksta*state.ta)
+
+            image.alpha[idx] = alpha
+            image.buf[idx] = v_ir/alpha
+
+        scan_limits(image.buf, indices, image.exclude, limits)
+
+
+class FusedKernel:
+    # per-frame terms are folded into scalars up front so that the
+    # per-pixel work is a single pass over preallocated arrays
+    def __init__(self, calib):
+        self.calib = calib
+
+    def temperature_map(self, image, state, out, ext, indices, sp_id, interleaved):
+        scalar_temperature_map(self.calib, image, state, out, ext, indices)
+
+    def update(self, image, raw, indices, sp_id, interleaved, state, limits):
+        calib = self.calib
+        pix_os_ref = calib.pix_os_ref
+        pix_kta = calib.pix_kta
+        pix_kv = calib.pix_kv
+        pix_alpha = calib.pix_alpha
+        il_offset = calib.il_offset
+        v_ir_out = image.v_ir
+        alpha_out = image.alpha
+        buf = image.buf
+        exclude = image.exclude
+
+        ta = state.ta
+        vdd = state.vdd
+        gain = state.gain
+        emissivity = calib.emissivity
+        alpha_ta = 1 + calib.ksta*ta
+
+        tgc_os = 0.0
+        tgc_alpha = 0.0
+        if calib.use_tgc:
+            tgc_os = calib.tgc*calc_os_cp(calib, sp_id, interleaved, state)
+            tgc_alpha = calib.tgc*calib.pix_alpha_cp[sp_id]
+
+        min_h, max_h = _INF, -_INF
+        min_idx = max_idx = None
+        if interleaved:
+            for idx in indices:
+                offset = pix_os_ref[idx]*((1 + pix_kta[idx]*ta)*(1 + pix_kv[idx]*vdd))
+                v_ir = (raw[idx]*gain - offset + il_offset[idx])/emissivity - tgc_os
+                alpha = (pix_alpha[idx] - tgc_alpha)*alpha_ta
+                v_ir_out[idx] = v_ir
+                alpha_out[idx] = alpha
+                h = v_ir/alpha
+                buf[idx] = h
+                if exclude[idx]:
+                    continue
+                if h < min_h:
+                    min_h, min_idx = h, idx
+                if h > max_h:
+                    max_h, max_idx = h, idx
+        else:
+            for idx in indices:
+                offset = pix_os_ref[idx]*((1 + pix_kta[idx]*ta)*(1 + pix_kv[idx]*vdd))
+                v_ir = (raw[idx]*gain - offset)/emissivity - tgc_os
+                alpha = (pix_alpha[idx] - tgc_alpha)*alpha_ta
+                v_ir_out[idx] = v_ir
+                alpha_out[idx] = alpha
+                h = v_ir/alpha
+                buf[idx] = h
+                if exclude[idx]:
+                    continue
+                if h < min_h:
+                    min_h, min_idx = h, idx
+                if h > max_h:
+                    max_h, max_idx = h, idx
+
+        # limits are taken from buf so that they match the stored precision
+        limits[0] = buf[min_idx] if min_idx is not None else min_h
+        limits[1] = buf[max_idx] if max_idx is not None else max_h
+        limits[2] = min_idx
+        limits[3] = max_idx
+
+
+class ArrayKernel:
+    # whole-frame ndarray implementation
+    # the frame is computed in full and then merged into the image planes
+    # for the pixels of the subpage being updated
+    def __init__(self, calib):
+        self.calib = calib
+        self._float = np.float32 if hasattr(np, 'float32') else np.float
+
+        self.pix_os_ref = np.array(calib.pix_os_ref, dtype=self._float)
+        self.pix_kta = np.array(calib.pix_kta, dtype=self._float)
+        self.pix_kv = np.array(calib.pix_kv, dtype=self._float)
+        self.pix_alpha = np.array(calib.pix_alpha, dtype=self._float)
+        self.il_offset = np.array(calib.il_offset, dtype=self._float)
+
+        self._sp_maps = {}
+        self._masks = {}
+        self._valid = {}
+        self._exclude_version = None
+        self._views = {}
+
+    def _get_sp_map(self, indices, sp_id, interleaved):
+        # 1 for the pixels of the subpage, 0 otherwise
+        key = (interleaved, sp_id)
+        sp_map = self._sp_maps.get(key)
+        if sp_map is None:
+            sp_map = np.zeros(IMAGE_SIZE, dtype=np.uint8)
+            for idx in indices:
+                sp_map[idx] = 1
+            self._sp_maps[key] = sp_map
+        return sp_map
+
+    def _get_mask(self, indices, sp_id, interleaved):
+        key = (interleaved, sp_id)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = self._masks[key] = self._get_sp_map(indices, sp_id, interleaved) == 1
+        return mask
+
+    def _get_valid(self, image, indices, sp_id, interleaved):
+        # subpage pixels that are not excluded from the limits
+        if image.exclude_version != self._exclude_version:
+            self._valid = {}
+            self._exclude_version = image.exclude_version
+        key = (interleaved, sp_id)
+        valid = self._valid.get(key)
+        if valid is None:
+            exclude = np.array(image.exclude, dtype=np.uint8)
+            sp_map = self._get_sp_map(indices, sp_id, interleaved)
+            valid = self._valid[key] = sp_map*(1 - exclude) == 1
+        return valid
+
+    def _view(self, buf, dtype):
+        # ndarray sharing memory with buf
+        # keeps a reference to buf so that its id is not reused
+        cached = self._views.get(id(buf))
+        if cached is None:
+            cached = self._views[id(buf)] = (buf, np.frombuffer(buf, dtype=dtype))
+        return cached[1]
+
+    def update(self, image, raw, indices, sp_id, interleaved, state, limits):
+        calib = self.calib
+        mask = self._get_mask(indices, sp_id, interleaved)
+        raw = self._view(raw, np.int16)
+
+        ta = state.ta
+        offset = self.pix_os_ref*((1 + self.pix_kta*ta)*(1 + self.pix_kv*state.vdd))
+        v_os = raw*state.gain - offset
+        if interleaved:
+            v_os = v_os + self.il_offset
+        v_ir = v_os/calib.emissivity
+        alpha = self.pix_alpha
+        if calib.use_tgc:
+            v_ir = v_ir - calib.tgc*calc_os_cp(calib, sp_id, interleaved, state)
+            alpha = alpha - calib.tgc*calib.pix_alpha_cp[sp_id]
+        alpha = alpha*(1 + calib.ksta*ta)
+
+        v_ir_out = self._view(image.v_ir, self._float)
+        alpha_out = self._view(image.alpha, self._float)
+        buf_out = self._view(image.buf, self._float)
+        v_ir_out[:] = np.where(mask, v_ir, v_ir_out)
+        alpha_out[:] = np.where(mask, alpha, alpha_out)
+        buf_out[:] = np.where(mask, v_ir/alpha, buf_out)
+
+        valid = self._get_valid(image, indices, sp_id, interleaved)
+        min_idx = int(np.argmin(np.where(valid, buf_out, _INF)))
+        max_idx = int(np.argmax(np.where(valid, buf_out, -_INF)))
+        if valid[min_idx]:
+            limits[0] = float(buf_out[min_idx])
+            limits[1] = float(buf_out[max_idx])
+            limits[2] = min_idx
+            limits[3] = max_idx
+        else:
+            limits[0], limits[1] = _INF, -_INF
+            limits[2] = limits[3] = None
+
+    def temperature_map(self, image, state, out, ext, indices, sp_id, interleaved):
+        calib = self.calib
+        v_ir = self._view(image.v_ir, self._float)
+        alpha = self._view(image.alpha, self._float)
+        ta_r = state.ta_r
+        ksto1 = calib.ksto[1]
+
+        alpha_3 = alpha*alpha*alpha
+        s_x = np.sqrt(np.sqrt(v_ir*alpha_3 + ta_r*alpha_3*alpha))*ksto1
+        to = np.sqrt(np.sqrt(v_ir/(alpha*(1 - TEMP_K*ksto1) + s_x) + ta_r)) - TEMP_K
+
+        if ext:
+            # per-pixel extended range band coefficients
+            ct = calib.ct
+            ksto = calib.ksto
+            alpha_ext = calib.alpha_ext
+            band_ct = ct[0]
+            band_ksto = ksto[0]
+            band_alpha = alpha_ext[0]
+            for band in range(1, len(ct)):
+                in_band = to >= ct[band]
+                band_ct = np.where(in_band, ct[band], band_ct)
+                band_ksto = np.where(in_band, ksto[band], band_ksto)
+                band_alpha = np.where(in_band, alpha_ext[band], band_alpha)
+
+            to_ext = v_ir/(alpha*band_alpha*(1 + band_ksto*(to - band_ct))) + ta_r
+            to_ext = np.sqrt(np.sqrt(to_ext)) - TEMP_K
+            to = np.where(to < ct[0], ct[0] - calib.drift, to_ext)
+
+        to = to + calib.drift
+
+        out = self._view(out, self._float)
+        if indices is None:
+            out[:] = to
+        else:
+            out[:] = np.where(self._get_mask(indices, sp_id, interleaved), to, out)
+
+
+KERNELS = {
+    'fused' : FusedKernel,
+    'reference' : ReferenceKernel,
+}
+if np is not None:
+    KERNELS['array'] = ArrayKernel
+
+# the array backend allocates whole-frame temporaries on every update, so the
+# device defaults to the allocation-free fused kernel; ulab can still be
+# chosen with ProcessedImage.set_backend('array')
+if np is not None and sys.implementation.name != 'micropython':
+    DEFAULT_BACKEND = 'array'
+else:
+    DEFAULT_BACKEND = 'fused'
@@ -1,27 +1,50 @@
 import math
-import struct
 from array import array
-from ucollections import namedtuple
 from utils import (
     Struct,
     StructProto,
     field_desc,
     array_filled,
+    word_array,
 )
 
 from mlx90640.regmap import REG_SIZE
-from mlx90640.calibration import NUM_COLS, IMAGE_SIZE, TEMP_K
+from mlx90640.calibration import NUM_ROWS, NUM_COLS, IMAGE_SIZE, TEMP_K
+from mlx90640.compensation import KERNELS, DEFAULT_BACKEND, scan_limits
 
-PIX_STRUCT_FMT = const('>h')
 PIX_DATA_ADDRESS = const(0x0400)
 
+# subpage lookup tables, keyed by (pattern_id, sp_id)
+_SP_INDICES = {}
+_SP_SPANS = {}
+
 class _BasePattern:
     @classmethod
     def sp_range(cls, sp_id):
-        return (
-            idx for idx, sp in enumerate(cls.iter_sp()) 
-            if sp == sp_id
-        )
+        return cls.sp_indices(sp_id)
+
+    @classmethod
+    def sp_indices(cls, sp_id):
+        # array of the pixel indices belonging to a subpage, built on first use
+        key = (cls.pattern_id, sp_id)
+        indices = _SP_INDICES.get(key)
+        if indices is None:
+            indices = array('H', (
+                idx for idx, sp in enumerate(cls.iter_sp())
+                if sp == sp_id
+            ))
+            _SP_INDICES[key] = indices
+        return indices
+
+    @classmethod
+    def sp_spans(cls, sp_id):
+        # contiguous (start, count) runs of a subpage's pixel indices
+        key = (cls.pattern_id, sp_id)
+        spans = _SP_SPANS.get(key)
+        if spans is None:
+            spans = tuple(_iter_runs(cls.sp_indices(sp_id)))
+            _SP_SPANS[key] = spans
+        return spans
 
     @classmethod
     def iter_sp(cls):
@@ -29,6 +52,18 @@ class _BasePattern:
             cls.get_sp(idx) for idx in range(IMAGE_SIZE)
         )
 
+def _iter_runs(indices):
+    start = end = None
+    for idx in indices:
+        if idx == end:
+            end += 1
+            continue
+        if start is not None:
+            yield start, end - start
+        start, end = idx, idx + 1
+    if start is not None:
+        yield start, end - start
+
 class ChessPattern(_BasePattern):
     pattern_id = 0x1
 
@@ -55,99 +90,296 @@ class Subpage:
     def __init__(self, pattern, sp_id):
         self.pattern = pattern
         self.id = sp_id
+        self.key = _subpage_key(pattern, sp_id)
+        self._indices = None
+        self._spans = None
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self._indices = self.pattern.sp_indices(self.id)
+        return self._indices
+
+    @property
+    def spans(self):
+        if self._spans is None:
+            self._spans = self.pattern.sp_spans(self.id)
+        return self._spans
 
     def sp_range(self):
-        return self.pattern.sp_range(self.id)
+        return self.indices
+
+def _subpage_key(pattern, sp_id):
+    # small int key, looking up a tuple key would allocate
+    return pattern.pattern_id << 3 | sp_id
+
+_SUBPAGES = {}
+
+def get_subpage(pattern, sp_id):
+    # shared Subpage instances, these should not be modified
+    key = _subpage_key(pattern, sp_id)
+    subpage = _SUBPAGES.get(key)
+    if subpage is None:
+        subpage = _SUBPAGES[key] = Subpage(pattern, sp_id)
+    return subpage
 
 
 ## Image Buffers
 
+def _burst_spans(spans, merge_gap, max_burst):
+    # join contiguous (start, count) spans into bursts
+    # gaps of up to merge_gap words are read through rather than
+    # starting a new transaction
+    start = end = None
+    for span_start, count in spans:
+        if start is not None and span_start - end <= merge_gap:
+            end = span_start + count
+            continue
+        if start is not None:
+            yield from _split_span(start, end - start, max_burst)
+        start, end = span_start, span_start + count
+    if start is not None:
+        yield from _split_span(start, end - start, max_burst)
+
+def _split_span(start, count, max_burst):
+    if not max_burst:
+        yield start, count
+        return
+    for offset in range(0, count, max_burst):
+        yield start + offset, min(max_burst, count - offset)
+
 class RawImage:
-    def __init__(self):
+    def __init__(self, *, max_burst=None, merge_gap=4):
+        # max_burst limits the number of words read per transaction (None for no limit)
+        # merge_gap is the largest gap in words that a burst will read through
         self.pix = array_filled('h', IMAGE_SIZE)
+        self.max_burst = max_burst
+        self.merge_gap = merge_gap
 
-    def __getitem__(self, idx):
-        return self.pix[idx]
-
-    def read(self, iface, update_idx = None):
-        buf = bytearray(REG_SIZE)
-        update_idx = update_idx or range(IMAGE_SIZE)
-        for offset in update_idx:
-            iface.read_into(PIX_DATA_ADDRESS + offset, buf)
-            self.pix[offset] = struct.unpack(PIX_STRUCT_FMT, buf)[0]
+        self._buf = bytearray(IMAGE_SIZE * REG_SIZE)
+        self._words = word_array(self._buf, signed=True)
+        self._plans = {}
 
+        # bus cost of the last read
+        self.transactions = 0
+        self.bytes_read = 0
 
-ImageLimits = namedtuple('ScaleLimits', ('min_h', 'max_h', 'min_idx', 'max_idx'))
+    def __getitem__(self, idx):
+        return self.pix[idx]
 
-_INTERP_NEIGHBOURS = tuple(
-    row * NUM_COLS + col
-    for row in (-1, 0, 1)
-    for col in (-1, 0, 1)
-    if row != 0 or col != 0
-)
+    @property
+    def buf(self):
+        # the pixel words as last read from the device, big-endian
+        return self._buf
+
+    def _get_plan(self, subpage):
+        key = subpage.key if subpage is not None else None
+        plan = self._plans.get(key)
+        if plan is None:
+            spans = subpage.spans if subpage is not None else ((0, IMAGE_SIZE),)
+            buf = memoryview(self._buf)
+            plan = tuple(
+                (PIX_DATA_ADDRESS + start, buf[start*REG_SIZE:(start + count)*REG_SIZE])
+                for start, count in _burst_spans(spans, self.merge_gap, self.max_burst)
+            )
+            self._plans[key] = plan
+        return plan
+
+    def read(self, iface, subpage=None):
+        plan = self._get_plan(subpage)
+        nbytes = 0
+        for address, buf in plan:
+            iface.read_into(address, buf)
+            nbytes += len(buf)
+        self.transactions = len(plan)
+        self.bytes_read = nbytes
+
+        pix = self.pix
+        words = self._words
+        update_idx = subpage.indices if subpage is not None else range(IMAGE_SIZE)
+        for idx in update_idx:
+            pix[idx] = words[idx]
+
+
+class ImageLimits:
+    # min/max of an image, the indices are None if there were no pixels to scan
+    def __init__(self, min_h=None, max_h=None, min_idx=None, max_idx=None):
+        self.min_h = min_h
+        self.max_h = max_h
+        self.min_idx = min_idx
+        self.max_idx = max_idx
+
+    def copy_from(self, other):
+        self.min_h = other.min_h
+        self.max_h = other.max_h
+        self.min_idx = other.min_idx
+        self.max_idx = other.max_idx
+
+def merge_bad_pixels(calib, bad_pixels=()):
+    # configured bad pixels plus the outliers and failed pixels flagged in the EEPROM
+    merged = set(bad_pixels)
+    merged.update(calib.outliers)
+    merged.update(calib.pix_data.failed)
+    return tuple(sorted(merged))
+
+class InterpolationPlan:
+    # bad pixels are replaced by the mean of their good neighbours
+    # the neighbour lists and weights are worked out once up front
+    def __init__(self, bad_pixels):
+        self.bad_pixels = bad_pixels
+        bad = set(bad_pixels)
+
+        targets = []
+        bounds = [0]
+        neighbours = []
+        weights = []
+        for bad_idx in sorted(bad):
+            row, col = divmod(bad_idx, NUM_COLS)
+            found = [
+                r * NUM_COLS + c
+                for r in range(max(row - 1, 0), min(row + 2, NUM_ROWS))
+                for c in range(max(col - 1, 0), min(col + 2, NUM_COLS))
+                if r * NUM_COLS + c not in bad
+            ]
+            if len(found) == 0:
+                continue
+            targets.append(bad_idx)
+            neighbours.extend(found)
+            bounds.append(len(neighbours))
+            weights.append(1.0/len(found))
+
+        self.targets = array('H', targets)
+        self.bounds = array('H', bounds)  # neighbours of targets[i] are [bounds[i]:bounds[i+1]]
+        self.neighbours = array('H', neighbours)
+        self.weights = array('f', weights)
+
+    def apply(self, buf):
+        targets = self.targets
+        bounds = self.bounds
+        neighbours = self.neighbours
+        weights = self.weights
+        for i in range(len(targets)):
+            total = 0.0
+            for j in range(bounds[i], bounds[i+1]):
+                total += buf[neighbours[j]]
+            buf[targets[i]] = total*weights[i]
 
 class ProcessedImage:
-    def __init__(self, calib):
-        # pix_data should be a sequence of ints
+    def __init__(self, calib, *, backend=DEFAULT_BACKEND):
         self.calib = calib
         self.v_ir = array_filled('f', IMAGE_SIZE, 0.0)
         self.alpha = array_filled('f', IMAGE_SIZE, 1.0)
         self.buf = array_filled('f', IMAGE_SIZE, 1.0)
 
-    def update(self, pix_data, subpage, state):
-        if self.calib.use_tgc:
-            pix_os_cp = self._calc_os_cp(subpage, state)
-            pix_alpha_cp = self.calib.pix_alpha_cp[subpage.id]
-
-        for idx, raw in pix_data:
-            ## IR data compensation - offset, Vdd, and Ta
-            kta = self.calib.pix_kta[idx]
-
-            row, col = divmod(idx, NUM_COLS)
-            kv = self.calib.kv_avg[row % 2][col % 2]
-            
-            offset = self.calib.pix_os_ref[idx]
-            offset *= (1 + kta*state.ta)*(1 + kv*state.vdd)
-
-            v_os = raw*state.gain - offset
-            if subpage.pattern is InterleavedPattern:
-                v_os += self.calib.il_offset[idx]
-            v_ir = v_os / self.calib.emissivity
-
-            ## IR data gradient compensation
-            if self.calib.use_tgc:
-                v_ir -= self.calib.tgc*pix_os_cp
-
-            # preserve v_ir for temperature calculations
-            self.v_ir[idx] = v_ir
-
-            alpha = self._calc_alpha(idx, state.ta)
-            self.buf[idx] = v_ir/alpha
-
-    def _calc_os_cp(self, subpage, state):
-        pix_os_cp = self.calib.pix_os_cp[subpage.id]
-        if subpage.pattern is InterleavedPattern:
-            pix_os_cp += self.calib.il_chess_c1
-        return state.gain_cp[subpage.id] - pix_os_cp*(1 + self.calib.kta_cp*state.ta)*(1 + self.calib.kv_cp*state.vdd)
-
-    def _calc_os_cp2(self, pattern, state):
-        pix_os_cp = list(self.calib.pix_os_cp)
-        if pattern is InterleavedPattern:
-            for i in range(len(pix_os_cp)):
-                pix_os_cp[i] += self.calib.il_chess_c1
-
-        k = (1 + self.calib.kta_cp*state.ta)*(1 + self.calib.kv_cp*state.vdd)
-        return [
-            gain_cp_sp - pix_os_cp_sp*k
-            for pix_os_cp_sp, gain_cp_sp in zip(pix_os_cp, state.gain_cp)
-        ]
-
-    def _calc_alpha(self, idx, ta):
-        alpha = self.calib.pix_alpha[idx]
-        if self.calib.use_tgc:
-            alpha -= self.calib.tgc*pix_alpha_cp
-        alpha *= (1 + self.calib.ksta*ta)
-        return alpha
+        # pixels flagged here are left out of the limits
+        self.exclude = bytearray(IMAGE_SIZE)
+        self.exclude_version = 0
+        self._exclude_idx = ()
+
+        # limits are tracked per subpage of the pattern last used
+        self._limits_pattern = None
+        self._sp_limits = ([None]*4, [None]*4)
+        self._sp_valid = [False, False]
+        self._limits = ImageLimits()
+        self._limits_valid = False
+
+        self._interp_plan = None
+        # plan and exclude_version for which all interpolated pixels are excluded
+        self._interp_excluded = None
+        self._interp_excluded_version = None
+
+        # optional temporal.TemporalFilter applied after the kernel
+        self.filter = None
+
+        self.set_backend(backend)
+
+    def set_backend(self, name):
+        # name should be one of compensation.KERNELS
+        self._kernel = KERNELS[name](self.calib)
+        self.backend = name
+
+    def set_filter(self, temporal_filter):
+        # temporal_filter should be a temporal.TemporalFilter, or None to disable filtering
+        if temporal_filter is not None:
+            temporal_filter.reset()
+        self.filter = temporal_filter
+
+    def update(self, raw, subpage, state):
+        # raw should be a sequence of raw pixel values for the whole frame
+        if subpage.pattern is not self._limits_pattern:
+            self.invalidate_limits()
+            self._limits_pattern = subpage.pattern
+
+        interleaved = subpage.pattern is InterleavedPattern
+        limits = self._sp_limits[subpage.id]
+        self._kernel.update(self, raw, subpage.indices, subpage.id, interleaved, state, limits)
+        if self.filter is not None:
+            self.filter.apply(self, subpage, state, limits)
+        self._sp_valid[subpage.id] = True
+        self._limits_valid = False
+
+    ## Limits
+
+    def set_exclusions(self, exclude_idx):
+        # exclude_idx should be a sequence of pixel indices
+        exclude = self.exclude
+        for idx in range(IMAGE_SIZE):
+            exclude[idx] = 0
+        for idx in exclude_idx:
+            exclude[idx] = 1
+        self._exclude_idx = exclude_idx
+        self.exclude_version += 1
+        self.invalidate_limits()
+
+    def invalidate_limits(self, subpage=None):
+        # call after modifying buf outside of update()
+        if subpage is None or subpage.pattern is not self._limits_pattern:
+            self._sp_valid[0] = self._sp_valid[1] = False
+        else:
+            self._sp_valid[subpage.id] = False
+        self._limits_valid = False
+
+    def calc_limits(self, *, exclude_idx=None):
+        # results are cached until the image or the exclusions change
+        # the same ImageLimits is updated in place, copy it to keep it
+        if exclude_idx is not None and exclude_idx is not self._exclude_idx:
+            if tuple(exclude_idx) != tuple(self._exclude_idx):
+                self.set_exclusions(exclude_idx)
+            self._exclude_idx = exclude_idx
+
+        if not self._limits_valid:
+            self._merge_limits(self._limits)
+            self._limits_valid = True
+        return self._limits
+
+    def _merge_limits(self, result):
+        pattern = self._limits_pattern
+        if pattern is None:
+            # nothing has been processed yet
+            limits = self._sp_limits[0]
+            scan_limits(self.buf, range(IMAGE_SIZE), self.exclude, limits)
+            if limits[2] is None:
+                result.min_h = result.max_h = result.min_idx = result.max_idx = None
+            else:
+                result.min_h, result.max_h, result.min_idx, result.max_idx = limits
+            return
+
+        min_h = max_h = min_idx = max_idx = None
+        for sp_id in range(2):
+            limits = self._sp_limits[sp_id]
+            if not self._sp_valid[sp_id]:
+                scan_limits(self.buf, get_subpage(pattern, sp_id).indices, self.exclude, limits)
+                self._sp_valid[sp_id] = True
+            if limits[2] is None:
+                continue
+            if min_idx is None or limits[0] < min_h:
+                min_h, min_idx = limits[0], limits[2]
+            if max_idx is None or limits[1] > max_h:
+                max_h, max_idx = limits[1], limits[3]
+        result.min_h = min_h
+        result.max_h = max_h
+        result.min_idx = min_idx
+        result.max_idx = max_idx
 
     def _calc_to(self, idx, alpha, ta_r):
         v_ir = self.v_ir[idx]
@@ -160,12 +392,12 @@ class ProcessedImage:
         return to + self.calib.drift
 
     def calc_temperature(self, idx, state):
-        alpha = self._calc_alpha(idx, state.ta)
+        alpha = self.alpha[idx]
         return self._calc_to(idx, alpha, state.ta_r)
 
     def calc_temperature_ext(self, idx, state):
         v_ir = self.v_ir[idx]
-        alpha = self._calc_alpha(idx, state.ta)
+        alpha = self.alpha[idx]
         to = self._calc_to(idx, alpha, state.ta_r)
 
         band = self._get_range_band(to)
@@ -179,30 +411,39 @@ class ProcessedImage:
         to_ext = math.sqrt(math.sqrt(to_ext)) - TEMP_K
         return to_ext  + self.calib.drift
 
+    def temperature_map(self, out, state, *, ext=True, subpage=None):
+        # fill out (an array('f') of IMAGE_SIZE) with the temperature in degC of every pixel
+        # if subpage is given only the pixels of that subpage are written
+        if subpage is None:
+            self._kernel.temperature_map(self, state, out, ext, None, None, None)
+        else:
+            interleaved = subpage.pattern is InterleavedPattern
+            self._kernel.temperature_map(self, state, out, ext, subpage.indices, subpage.id, interleaved)
+
     def _get_range_band(self, t):
-        return sum(1 for ct in self.calib.ct if t >= ct) - 1
-
-    def calc_limits(self, *, exclude_idx=()):
-        # find min/max in place to keep mem usage down
-        min_h, min_idx = None, None
-        max_h, max_idx = None, None
-        for idx, h in enumerate(self.buf):
-            if idx in exclude_idx:
-                continue
-            if min_h is None or h < min_h:
-                min_h, min_idx = h, idx
-            if max_h is None or h > max_h:
-                max_h, max_idx = h, idx
-        return ImageLimits(min_h, max_h, min_idx, max_idx)
+        ct = self.calib.ct
+        band = len(ct) - 1
+        while band >= 0 and t < ct[band]:
+            band -= 1
+        return band
 
     def interpolate_bad_pixels(self, bad_pixels):
-        for bad_idx in bad_pixels:
-            count = 0
-            total = 0
-            for offset in _INTERP_NEIGHBOURS:
-                idx = bad_idx + offset
-                if idx in range(IMAGE_SIZE) and idx not in bad_pixels:
-                    count += 1
-                    total += self.buf[idx]
-            if count > 0:
-                self.buf[bad_idx] = total/count
+        # bad_pixels may be an InterpolationPlan or a sequence of pixel indices
+        plan = bad_pixels
+        if not isinstance(plan, InterpolationPlan):
+            plan = self._interp_plan
+            if plan is None or plan.bad_pixels is not bad_pixels:
+                plan = self._interp_plan = InterpolationPlan(bad_pixels)
+
+        plan.apply(self.buf)
+
+        # limits only need refreshing if an interpolated pixel is not excluded
+        if plan is self._interp_excluded and self.exclude_version == self._interp_excluded_version:
+            return
+        exclude = self.exclude
+        for idx in plan.targets:
+            if not exclude[idx]:
+                self.invalidate_limits()
+                return
+        self._interp_excluded = plan
+        self._interp_excluded_version = self.exclude_version
@@ -0,0 +1,252 @@
+""" Append-only recording of raw subpages.
+
+A recording holds everything needed to redo the compensation offline: the
+EEPROM image in the file header, then one fixed size record per subpage with
+the raw pixel words of that subpage, the control register and the auxiliary
+registers behind CameraState, all as read from the device (big-endian).
+
+    header   magic, version, record size, index interval, word counts
+             EEPROM image
+    records  sync, subpage id, pattern id, sequence number, time in ms
+             control register, auxiliary registers, subpage pixel words
+    index    time of every index interval'th record
+    footer   index entry count, index magic
+
+The index and footer are written by Recorder.close(). A recording that was
+cut short has no index, RecordingReader rebuilds it from the records.
+"""
+
+import struct
+import time
+from array import array
+
+from mlx90640.regmap import REG_SIZE, EEPROM_ADDRESS, EEPROM_SIZE, AUX_SIZE, MemoryImage
+from mlx90640.calibration import IMAGE_SIZE
+from mlx90640.image import get_subpage, get_pattern_by_id
+
+_MAGIC = const(b'MLXR')
+_INDEX_MAGIC = const(b'MLXI')
+_VERSION = const(1)
+_SYNC = const(b'SP')
+
+# magic, version, record size, index interval, EEPROM words, aux words, pixel words
+_HEADER_FMT = const('>4sBxHHHHH')
+# sync, subpage id, pattern id, sequence number, time in ms
+_RECORD_FMT = const('>2sBBII')
+# index entry count, index magic
+_FOOTER_FMT = const('>I4s')
+
+PIXEL_WORDS = IMAGE_SIZE // 2  # pixels per subpage
+
+_CONTROL_OFFSET = const(12)  # struct.calcsize(_RECORD_FMT)
+_AUX_OFFSET = _CONTROL_OFFSET + REG_SIZE
+_PIX_OFFSET = _AUX_OFFSET + AUX_SIZE * REG_SIZE
+RECORD_SIZE = _PIX_OFFSET + PIXEL_WORDS * REG_SIZE
+
+DEFAULT_INDEX_INTERVAL = const(64)
+
+class RecordingFormatError(Exception): pass
+
+
+class Recorder:
+    def __init__(self, path, camera, *, buffer_records=4, index_interval=DEFAULT_INDEX_INTERVAL):
+        # camera should be a set up MLX90640, the header takes its EEPROM image
+        # records are collected in a buffer of buffer_records and written together
+        # the file is flushed whenever an index entry is added
+        self.index_interval = index_interval
+        self.records = 0
+        self.index = array('I')  # time_ms of records 0, index_interval, ...
+
+        self._buf = bytearray(RECORD_SIZE * buffer_records)
+        self._fill = 0
+        self._sync = False
+        self._time_ms = 0
+        self._last_ms = None
+
+        if len(camera.aux_buf()) != AUX_SIZE * REG_SIZE:
+            raise ValueError("camera aux registers do not match the record layout")
+
+        self._file = open(path, 'wb')
+        self._file.write(struct.pack(
+            _HEADER_FMT, _MAGIC, _VERSION, RECORD_SIZE, index_interval,
+            EEPROM_SIZE, AUX_SIZE, PIXEL_WORDS,
+        ))
+        self._file.write(camera.eeprom_image.buf)
+
+    def write(self, camera, sp_id):
+        # records the subpage last read by camera.read_image() and the
+        # registers last read by camera.read_state()
+        now = time.ticks_ms()
+        if self._last_ms is not None:
+            self._time_ms += time.ticks_diff(now, self._last_ms)
+        self._last_ms = now
+
+        buf = self._buf
+        offset = self._fill * RECORD_SIZE
+        pattern = camera.pattern
+        struct.pack_into(
+            _RECORD_FMT, buf, offset,
+            _SYNC, sp_id, pattern.pattern_id, self.records, self._time_ms,
+        )
+
+        control = camera.read_control().buf  # shadowed, no bus traffic
+        dst = offset + _CONTROL_OFFSET
+        buf[dst] = control[0]
+        buf[dst + 1] = control[1]
+
+        dst = offset + _AUX_OFFSET
+        buf[dst:dst + AUX_SIZE * REG_SIZE] = camera.aux_buf()
+
+        raw = camera.raw.buf
+        dst = offset + _PIX_OFFSET
+        for idx in get_subpage(pattern, sp_id).indices:
+            src = idx * REG_SIZE
+            buf[dst] = raw[src]
+            buf[dst + 1] = raw[src + 1]
+            dst += 2
+
+        if self.records % self.index_interval == 0:
+            self.index.append(self._time_ms)
+            self._sync = True
+        self.records += 1
+        self._fill += 1
+        if self._fill * RECORD_SIZE == len(buf):
+            self.flush()
+
+    def flush(self):
+        if self._fill:
+            if self._fill * RECORD_SIZE == len(self._buf):
+                self._file.write(self._buf)
+            else:
+                self._file.write(memoryview(self._buf)[:self._fill * RECORD_SIZE])
+            self._fill = 0
+        if self._sync:
+            self._file.flush()
+            self._sync = False
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        for time_ms in self.index:
+            self._file.write(struct.pack('>I', time_ms))
+        self._file.write(struct.pack(_FOOTER_FMT, len(self.index), _INDEX_MAGIC))
+        self._file.close()
+        self._file = None
+
+
+class Record:
+    # one subpage of a recording, refilled by RecordingReader.read()
+    def __init__(self):
+        self.buf = bytearray(RECORD_SIZE)
+        view = memoryview(self.buf)
+        self.control = view[_CONTROL_OFFSET:_AUX_OFFSET]
+        self.aux = view[_AUX_OFFSET:_PIX_OFFSET]  # words from AUX_ADDRESS
+        self.pix = view[_PIX_OFFSET:]  # words in subpage index order
+        self.sp_id = 0
+        self.pattern_id = 0
+        self.seq = 0
+        self.time_ms = 0
+
+    def _decode(self):
+        sync, self.sp_id, self.pattern_id, self.seq, self.time_ms = struct.unpack_from(_RECORD_FMT, self.buf)
+        if sync != _SYNC:
+            raise RecordingFormatError("bad record sync")
+
+    @property
+    def subpage(self):
+        return get_subpage(get_pattern_by_id(self.pattern_id), self.sp_id)
+
+    def unpack_pixels(self, pix):
+        # scatters the subpage's raw words into pix, such as RawImage.pix
+        src = self.pix
+        offset = 0
+        for idx in self.subpage.indices:
+            value = src[offset] << 8 | src[offset + 1]
+            pix[idx] = value - 0x10000 if value & 0x8000 else value
+            offset += 2
+
+
+class RecordingReader:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        header = self._file.read(struct.calcsize(_HEADER_FMT))
+        if len(header) != struct.calcsize(_HEADER_FMT):
+            raise RecordingFormatError("unexpected end of file")
+        magic, version, record_size, self.index_interval, eeprom_words, aux_words, pixel_words = (
+            struct.unpack(_HEADER_FMT, header))
+        if magic != _MAGIC:
+            raise RecordingFormatError("not a recording")
+        if version != _VERSION or record_size != RECORD_SIZE:
+            raise RecordingFormatError(f"unsupported recording version {version}")
+        if (eeprom_words, aux_words, pixel_words) != (EEPROM_SIZE, AUX_SIZE, PIXEL_WORDS):
+            raise RecordingFormatError("recording layout does not match")
+
+        self.eeprom = self._file.read(EEPROM_SIZE * REG_SIZE)
+        if len(self.eeprom) != EEPROM_SIZE * REG_SIZE:
+            raise RecordingFormatError("unexpected end of file")
+        self._data_start = self._file.tell()
+
+        self.index = self._read_index()
+
+    def _read_index(self):
+        end = self._file.seek(0, 2)
+        footer_size = struct.calcsize(_FOOTER_FMT)
+        if end - self._data_start >= footer_size:
+            self._file.seek(end - footer_size)
+            count, magic = struct.unpack(_FOOTER_FMT, self._file.read(footer_size))
+            index_start = end - footer_size - 4*count
+            if magic == _INDEX_MAGIC and index_start >= self._data_start:
+                self._file.seek(index_start)
+                self.records = (index_start - self._data_start) // RECORD_SIZE
+                return array('I', struct.unpack(f'>{count}I', self._file.read(4*count)))
+
+        # cut short, skip a partly written last record and rebuild the index
+        self.records = (end - self._data_start) // RECORD_SIZE
+        index = array('I')
+        record = Record()
+        for seq in range(0, self.records, self.index_interval):
+            index.append(self.read(seq, record).time_ms)
+        return index
+
+    def __len__(self):
+        return self.records
+
+    def eeprom_image(self):
+        image = MemoryImage(EEPROM_ADDRESS, EEPROM_SIZE)
+        image.buf[:] = self.eeprom
+        return image
+
+    def read(self, seq, record=None):
+        # reads record number seq into record, or a new Record
+        if not 0 <= seq < self.records:
+            raise IndexError(seq)
+        if record is None:
+            record = Record()
+        self._file.seek(self._data_start + seq * RECORD_SIZE)
+        if self._file.readinto(record.buf) != RECORD_SIZE:
+            raise RecordingFormatError("unexpected end of file")
+        record._decode()
+        return record
+
+    def iter_records(self, start=0, stop=None, record=None):
+        # the same Record is refilled for every step
+        if stop is None or stop > self.records:
+            stop = self.records
+        record = record or Record()
+        for seq in range(start, stop):
+            yield self.read(seq, record)
+
+    def find_time(self, time_ms):
+        # number of the first record at or after time_ms
+        entry = 0
+        while entry + 1 < len(self.index) and self.index[entry + 1] <= time_ms:
+            entry += 1
+        record = Record()
+        for seq in range(entry * self.index_interval, self.records):
+            if self.read(seq, record).time_ms >= time_ms:
+                return seq
+        return self.records
+
+    def close(self):
+        self._file.close()
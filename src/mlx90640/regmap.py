@@ -13,6 +13,17 @@ from utils import (
 
 REG_SIZE = const(2)
 
+STATUS_ADDRESS     = const(0x8000)
+CONTROL_ADDRESS    = const(0x800D)
+I2C_CONFIG_ADDRESS = const(0x800F)
+
+# registers that only change when written by the host, these can be shadowed
+HOST_REGISTERS = (CONTROL_ADDRESS, I2C_CONFIG_ADDRESS)
+
+# auxiliary measurements (Ta, gain, CP pixels, Vdd)
+AUX_ADDRESS = const(0x0700)
+AUX_SIZE    = const(0x2B)
+
 REGISTER_MAP = {
     # Status Register
     0x8000 : (
@@ -153,13 +164,97 @@ class CameraInterface:
 
 
 class ReadOnlyError(Exception): pass
+class VerifyError(Exception): pass
+
+class MemoryImage:
+    # in-memory snapshot of a contiguous range of device memory
+    # stands in for a read-only CameraInterface over that range
+    def __init__(self, address, size):
+        self.address = address  # first word address
+        self.size = size        # size in words
+        self.buf = bytearray(size * REG_SIZE)
+        self.transactions = 0   # bus transactions used by the last load
+        self._plan = None
+        self._plan_burst = None
+
+    def _get_plan(self, max_burst):
+        # (address, view) of every burst, kept so that reloading does not allocate
+        if self._plan_burst != max_burst:
+            buf = memoryview(self.buf)
+            self._plan = tuple(
+                (self.address + offset, buf[offset*REG_SIZE:min(offset + max_burst, self.size)*REG_SIZE])
+                for offset in range(0, self.size, max_burst)
+            )
+            self._plan_burst = max_burst
+        return self._plan
+
+    def load(self, iface, *, max_burst=0x100):
+        plan = self._get_plan(max_burst)
+        for address, view in plan:
+            iface.read_into(address, view)
+        self.transactions = len(plan)
+
+    def view(self, mem_addr, count=1):
+        # view of count words starting at mem_addr
+        offset = mem_addr - self.address
+        if offset < 0 or offset + count > self.size:
+            raise ValueError(f"address out of range: {mem_addr:#06x}")
+        return memoryview(self.buf)[offset*REG_SIZE:(offset + count)*REG_SIZE]
+
+    ## CameraInterface compatible access
+
+    def read(self, mem_addr):
+        return self.view(mem_addr)
+    def read_into(self, mem_addr, buf):
+        buf[:] = self.view(mem_addr, len(buf)//REG_SIZE)
+    def write(self, mem_addr, buf):
+        raise ReadOnlyError(f"can't write to {mem_addr:#06x}: memory image is read-only")
+
+class MemorySnapshot:
+    # a few MemoryImages loaded together and addressed as one
+    def __init__(self, ranges):
+        # ranges should be a sequence of (address, size in words)
+        self.images = tuple(MemoryImage(address, size) for address, size in ranges)
+
+    @property
+    def transactions(self):
+        return sum(image.transactions for image in self.images)
+
+    def load(self, iface):
+        for image in self.images:
+            image.load(iface)
+
+    def _find(self, mem_addr):
+        for image in self.images:
+            if image.address <= mem_addr < image.address + image.size:
+                return image
+        raise ValueError(f"address out of range: {mem_addr:#06x}")
+
+    ## CameraInterface compatible access
+
+    def read(self, mem_addr):
+        return self._find(mem_addr).read(mem_addr)
+    def read_into(self, mem_addr, buf):
+        self._find(mem_addr).read_into(mem_addr, buf)
+    def write(self, mem_addr, buf):
+        raise ReadOnlyError(f"can't write to {mem_addr:#06x}: memory image is read-only")
 
 class RegisterMap:
-    def __init__(self, iface, register_map, readonly=False):
+    def __init__(self, iface, register_map, readonly=False, cached=()):
         # register_map should be a dict of { I2C address : FieldDesc(s) }
+        # registers at the cached addresses are read once and then shadowed,
+        # writes go through to the device
+        self._setup(iface, self._build_lookup(register_map), readonly, cached)
+
+    def _setup(self, iface, fields, readonly, cached):
+        # fields as returned by _build_lookup(), shared with RegisterSnapshot
         self.iface = iface
         self.readonly = readonly
-        self._fields = self._build_lookup(register_map)
+        self._fields = fields
+        self._protos = {address: proto for address, proto in fields.values()}
+        self._cached = frozenset(cached)
+        self._shadow = {}    # { address : bytearray } of the cached registers
+        self._scratch = {}   # { address : (bytearray, Struct) } used by writes and read_struct()
 
     @staticmethod
     def _build_lookup(register_map):
@@ -183,21 +278,177 @@ class RegisterMap:
     def __contains__(self, name):
         return name in self._fields
 
-    def __getitem__(self, name):
-        address, proto = self._fields[name]
+    def _read(self, address):
+        buf = self._shadow.get(address)
+        if buf is None:
+            if address in self._cached:
+                buf = self._shadow[address] = bytearray(REG_SIZE)
+                self.iface.read_into(address, buf)
+            else:
+                buf = self.iface.read(address)
+        return buf
 
-        buf = self.iface.read(address)
-        struct = Struct(buf, proto)
-        return struct[name]
+    def _get_scratch(self, address):
+        scratch = self._scratch.get(address)
+        if scratch is None:
+            buf = bytearray(REG_SIZE)
+            scratch = self._scratch[address] = (buf, Struct(buf, self._protos[address]))
+        return scratch
+
+    def invalidate(self):
+        # drop the shadowed registers, e.g. after the device was reset
+        self._shadow.clear()
+
+    def read_struct(self, address):
+        # read a register once to decode several of its fields
+        # the same Struct is returned every time, it is valid until the next
+        # read_struct(), field read or write of that register
+        buf, struct = self._get_scratch(address)
+        shadow = self._shadow.get(address)
+        if shadow is None and address in self._cached:
+            shadow = self._read(address)
+        if shadow is not None:
+            buf[0] = shadow[0]
+            buf[1] = shadow[1]
+        else:
+            self.iface.read_into(address, buf)
+        return struct
+
+    def snapshot(self, ranges):
+        # read-only copy of the registers in ranges, read in one burst per range
+        # call load() on it to refresh
+        snapshot = RegisterSnapshot(self, ranges)
+        snapshot.load()
+        return snapshot
+
+    def transaction(self, *, verify=False):
+        # collects field writes and applies them per register on exit, see
+        # RegisterTransaction
+        if self.readonly:
+            raise ReadOnlyError("can't write to register map: not permitted")
+        return RegisterTransaction(self, verify)
+
+    def __getitem__(self, name):
+        address, _ = self._fields[name]
+        return self.read_struct(address)[name]
 
     def __setitem__(self, name, value):
         if self.readonly:
             raise ReadOnlyError(f"can't write to '{name}': not permitted")
 
-        address, proto = self._fields[name]
-
-        buf = bytearray(REG_SIZE)
-        self.iface.read_into(address, buf)
-        struct = Struct(buf, proto)
+        address, _ = self._fields[name]
+        buf, struct = self._get_scratch(address)
+        self._load_scratch(address, buf)
+        old_0, old_1 = buf[0], buf[1]
         struct[name] = value
-        self.iface.write(address, buf)
+        self._store_scratch(address, old_0, old_1, False)
+
+    def _write_fields(self, address, values, verify=False):
+        # one read (unless shadowed) and one write for any number of fields
+        # of the register at address. values should be a dict of { name : value }
+        buf, struct = self._get_scratch(address)
+        self._load_scratch(address, buf)
+        old_0, old_1 = buf[0], buf[1]
+        for name, value in values.items():
+            struct[name] = value
+        self._store_scratch(address, old_0, old_1, verify)
+
+    def _load_scratch(self, address, buf):
+        # reads the register contents into buf, the scratch buffer for the address
+        shadow = self._shadow.get(address)
+        if shadow is not None:
+            buf[0] = shadow[0]
+            buf[1] = shadow[1]
+        else:
+            self.iface.read_into(address, buf)
+
+    def _store_scratch(self, address, old_0, old_1, verify):
+        buf, _ = self._scratch[address]
+        shadow = self._shadow.get(address)
+        if shadow is None or buf[0] != old_0 or buf[1] != old_1:
+            self.iface.write(address, buf)
+        # else the device already holds this value, but it is still read
+        # back when verifying in case the shadow has gone stale
+        if verify:
+            check = bytearray(REG_SIZE)
+            self.iface.read_into(address, check)
+            if check != buf:
+                self._shadow.pop(address, None)
+                raise VerifyError(f"register {address:#06x} reads back {bytes(check)}, expected {bytes(buf)}")
+        if address in self._cached:
+            if shadow is None:
+                shadow = self._shadow[address] = bytearray(REG_SIZE)
+            shadow[0] = buf[0]
+            shadow[1] = buf[1]
+
+class RegisterTransaction:
+    # usage:
+    #   with registers.transaction() as txn:
+    #       txn['refresh_rate'] = 3
+    #       txn['read_pattern'] = 1
+    # fields are grouped by register so that each register is read (unless
+    # shadowed) and written once. nothing is written if the block raises.
+    def __init__(self, regmap, verify):
+        self.regmap = regmap
+        self.verify = verify
+        self._pending = {}  # { address : { name : value } }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._pending.clear()
+
+    def __setitem__(self, name, value):
+        address, _ = self.regmap._fields[name]
+        values = self._pending.get(address)
+        if values is None:
+            values = self._pending[address] = {}
+        values[name] = value
+
+    def __getitem__(self, name):
+        # pending values read back as written
+        address, _ = self.regmap._fields[name]
+        values = self._pending.get(address)
+        if values is not None and name in values:
+            return values[name]
+        return self.regmap[name]
+
+    def commit(self):
+        pending = self._pending
+        for address in sorted(pending):
+            self.regmap._write_fields(address, pending[address], self.verify)
+        pending.clear()
+
+class RegisterSnapshot(RegisterMap):
+    # fields of the snapshot ranges are decoded from memory without bus traffic,
+    # reading a field outside of them raises ValueError
+    def __init__(self, regmap, ranges):
+        self.source = regmap.iface
+        self._setup(MemorySnapshot(ranges), regmap._fields, True, ())
+
+        # a Struct over the snapshot memory for each register in it
+        self._structs = {}
+        for address, proto in self._protos.items():
+            for image in self.iface.images:
+                if image.address <= address < image.address + image.size:
+                    self._structs[address] = Struct(image.view(address), proto)
+
+    def load(self):
+        self.iface.load(self.source)
+
+    def __getitem__(self, name):
+        address, _ = self._fields[name]
+        struct = self._structs.get(address)
+        if struct is None:
+            raise ValueError(f"address out of range: {address:#06x}")
+        return struct[name]
+
+    def read_struct(self, address):
+        struct = self._structs.get(address)
+        if struct is None:
+            raise ValueError(f"address out of range: {address:#06x}")
+        return struct
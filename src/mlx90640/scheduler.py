@@ -0,0 +1,128 @@
+""" Data-ready scheduling for the subpage read loop.
+
+The sensor measures one subpage per refresh period from its own oscillator,
+which can run a few percent off nominal. Instead of polling the status
+register at a fixed interval, the scheduler learns the actual subpage period
+from the times at which new subpages are seen and wakes the reader just
+before the next one is due.
+"""
+
+import time
+
+class SubpageScheduler:
+    def __init__(self, period_ms, *, lead_ms=2, poll_ms=2, smoothing_shift=3):
+        # period_ms is the nominal subpage period (1000/refresh rate)
+        # lead_ms is how far ahead of the predicted subpage to wake up
+        # poll_ms is the status poll interval once awake
+        # each new period measurement is given a weight of 1/2**smoothing_shift
+        # all of the per-subpage arithmetic is on ints, so polling does not allocate
+        self.lead_ms = lead_ms
+        self.poll_ms = poll_ms
+        self.smoothing_shift = smoothing_shift
+
+        # readout mode, see configure()
+        self.alternating = True  # subpages are measured 0, 1, 0, 1, ...
+        self.overwrite = True    # new subpages replace unread data in RAM
+
+        self.reset(period_ms)
+
+    def reset(self, period_ms):
+        self.nominal_us = int(period_ms * 1000)
+        self.period_us = self.nominal_us  # learned subpage period
+        self._last_us = None   # when the last new subpage was seen
+        self._last_sp = None
+        self._first_poll = True
+
+        # counters
+        self.subpages = 0   # new subpages seen
+        self.missed = 0     # subpages measured by the sensor but never read
+        self.late = 0       # subpages that were already waiting when we woke
+        self.polls = 0      # status register reads
+        self.latency_us = 0      # upper bound on how long the last subpage waited
+        self.max_latency_us = 0
+
+    def configure(self, control, status):
+        # control and status should be the Structs returned by
+        # MLX90640.read_control() and read_status()
+        self.alternating = bool(control['subpage_enable']) and not control['subpage_repeat']
+        # with data_hold set, RAM is only updated if overwrite is enabled
+        self.overwrite = not control['data_hold'] or bool(status['overwrite_enable'])
+
+    @property
+    def period_ms(self):
+        return self.period_us/1000
+
+    def wake_delay_ms(self):
+        # how long to sleep before polling for the next subpage
+        self._first_poll = True
+        if self._last_us is None:
+            return 0
+        due = time.ticks_add(self._last_us, self.period_us - self.lead_ms*1000)
+        delay = time.ticks_diff(due, time.ticks_us())
+        return max(delay // 1000, 0)
+
+    def timeout_ms(self):
+        # give up on a subpage after two periods past the wake up
+        return self.lead_ms + 2*self.period_us//1000
+
+    def poll(self, status):
+        # status should be a read_status() result
+        # returns True if it shows a new subpage
+        now = time.ticks_us()
+        first_poll = self._first_poll
+        self._first_poll = False
+        self.polls += 1
+        if not status['data_available']:
+            return False
+
+        sp_id = status['last_subpage']
+        last_us = self._last_us
+        self._last_us = now
+        self._last_sp, last_sp = sp_id, self._last_sp
+        self.subpages += 1
+        if last_us is None:
+            return True
+
+        elapsed = time.ticks_diff(now, last_us)
+        missed = self._count_missed(elapsed, sp_id, last_sp, first_poll)
+        self.missed += missed
+
+        update = missed == 0
+        if first_poll:
+            # the subpage arrived some time before we woke up, so elapsed
+            # is only an upper bound on the period. the overshoot past the
+            # predicted arrival is taken off: a late wake up then leaves the
+            # estimate as it is, while a subpage that came early still
+            # moves it forward. the next period is measured from the
+            # estimated arrival rather than from now.
+            self.late += 1
+            expected = time.ticks_add(last_us, (missed + 1)*self.period_us)
+            overshoot = max(time.ticks_diff(now, expected), 0)
+            self.latency_us = overshoot
+            elapsed -= overshoot
+            self._last_us = time.ticks_add(now, -overshoot)
+        else:
+            self.latency_us = self.poll_ms*1000
+        self.latency_us = max(self.latency_us, 0)
+        self.max_latency_us = max(self.max_latency_us, self.latency_us)
+
+        if update:
+            period = self.period_us + ((elapsed - self.period_us) >> self.smoothing_shift)
+            nominal = self.nominal_us
+            self.period_us = min(max(period, nominal >> 1), nominal + (nominal >> 1))
+        return True
+
+    def _count_missed(self, elapsed, sp_id, last_sp, late):
+        # a subpage found on the first poll could have arrived any time
+        # before it, so the periods elapsed are rounded down
+        period = self.period_us
+        slack = period//10 if late else period >> 1
+        missed = max((elapsed + slack)//period - 1, 0)
+        if self.alternating and self.overwrite:
+            # RAM holds the latest subpage, an odd number of missed
+            # subpages shows up as a repeated subpage id. when RAM is held
+            # it has the first unread subpage and only the timing tells.
+            repeated = sp_id == last_sp
+            if (missed & 1) != repeated:
+                missed += 1
+        return missed
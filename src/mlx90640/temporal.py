@@ -0,0 +1,121 @@
+""" Temporal noise filtering of compensated subpages.
+
+A TemporalFilter runs after the kernel in ProcessedImage.update() and
+smooths the v_ir plane over successive readings of the same subpage, so the
+two halves of the chess pattern are never mixed. buf is recomputed from the
+filtered v_ir, so the display and the temperature calculation both see it.
+
+Pixels whose new reading differs from the filtered value by more than
+reset_k kelvin (roughly, judged around ambient temperature) start over from
+that reading, so moving objects and scene changes are not smeared.
+"""
+
+from utils import array_filled
+from mlx90640.calibration import IMAGE_SIZE
+from mlx90640.compensation import scan_limits
+
+FILTER_EMA = const(0)  # exponential moving average
+FILTER_BOX = const(1)  # mean of the last frames readings
+
+class TemporalFilter:
+    def __init__(self, mode=FILTER_EMA, *, frames=4, reset_k=2.0):
+        # frames is the length of the box average, the EMA gets the same
+        # lag with a weight of 2/(frames + 1) for each new reading
+        if frames < 1:
+            raise ValueError(f"frames should be at least 1: {frames}")
+        self.mode = mode
+        self.frames = frames
+        self.reset_k = reset_k
+        self.weight = 2/(frames + 1)
+
+        # EMA: the filtered v_ir, box: the sum of the history
+        self.plane = array_filled('f', IMAGE_SIZE, 0.0)
+        # box: the last frames readings of every pixel, slot major
+        self._history = array_filled('f', IMAGE_SIZE*frames, 0.0) if mode == FILTER_BOX else None
+        self._slot = [0, 0]    # next history slot, per subpage
+        self._primed = [False, False]
+        self._pattern = None
+
+        self.resets = 0  # pixels that started over
+
+    def reset(self):
+        self._primed[0] = self._primed[1] = False
+        self._slot[0] = self._slot[1] = 0
+
+    def apply(self, image, subpage, state, limits):
+        # filters image.v_ir over subpage and refills buf and limits to match
+        if subpage.pattern is not self._pattern:
+            self.reset()
+            self._pattern = subpage.pattern
+        sp_id = subpage.id
+        indices = subpage.indices
+
+        v_ir = image.v_ir
+        alpha = image.alpha
+        buf = image.buf
+        plane = self.plane
+        if not self._primed[sp_id]:
+            self._primed[sp_id] = True
+            for idx in indices:
+                self._start(idx, v_ir[idx])
+            return
+
+        # h = v_ir/alpha is about To**4 - Tr**4, so near ambient a change of
+        # reset_k kelvin moves it by 4*T**3*reset_k
+        threshold = 4*state.ta_r**0.75*self.reset_k
+        resets = 0
+        if self.mode == FILTER_EMA:
+            weight = self.weight
+            for idx in indices:
+                x = v_ir[idx]
+                y = plane[idx]
+                delta = x - y
+                if abs(delta) > threshold*alpha[idx]:
+                    resets += 1
+                    y = x
+                else:
+                    y += weight*delta
+                plane[idx] = y
+                v_ir[idx] = y
+                buf[idx] = y/alpha[idx]
+        else:
+            frames = self.frames
+            history = self._history
+            slot = self._slot[sp_id]
+            offset = slot*IMAGE_SIZE
+            for idx in indices:
+                x = v_ir[idx]
+                total = plane[idx]
+                if abs(x - total/frames) > threshold*alpha[idx]:
+                    resets += 1
+                    self._start(idx, x)
+                    continue
+                pos = offset + idx
+                total += x - history[pos]
+                history[pos] = x
+                plane[idx] = total
+                v_ir[idx] = total/frames
+                buf[idx] = v_ir[idx]/alpha[idx]
+            slot += 1
+            if slot == frames:
+                # resum every so often so float rounding does not build up
+                slot = 0
+                for idx in indices:
+                    total = 0.0
+                    for pos in range(idx, IMAGE_SIZE*frames, IMAGE_SIZE):
+                        total += history[pos]
+                    plane[idx] = total
+            self._slot[sp_id] = slot
+
+        self.resets += resets
+        scan_limits(buf, indices, image.exclude, limits)
+
+    def _start(self, idx, x):
+        # restart a pixel's filter from reading x, v_ir and buf are left as they are
+        if self.mode == FILTER_EMA:
+            self.plane[idx] = x
+            return
+        history = self._history
+        for pos in range(idx, IMAGE_SIZE*self.frames, IMAGE_SIZE):
+            history[pos] = x
+        self.plane[idx] = x*self.frames
@@ -0,0 +1,150 @@
+""" Lightweight timing of the frame loop.
+
+Code under test brackets a section with start()/stop(), which only read the
+clock while the profiler is enabled. Samples go into fixed size rolling
+histograms, so profiling does not allocate once every section has been seen.
+"""
+
+import gc
+import time
+from array import array
+
+_NUM_BANDS = const(21)  # power of two bands of microseconds, the last one open ended
+
+class Histogram:
+    # the last window samples, binned into power of two bands
+    def __init__(self, window=64):
+        self.samples = array('L', (0 for i in range(window)))
+        self.bands = array('H', (0 for i in range(_NUM_BANDS)))
+        self.count = 0  # samples added in total
+        self.max_us = 0
+        self._next = 0
+
+    def add(self, us):
+        if us < 0:
+            us = 0
+        samples = self.samples
+        if self.count >= len(samples):
+            self.bands[_band(samples[self._next])] -= 1
+        samples[self._next] = us
+        self.bands[_band(us)] += 1
+        self._next = (self._next + 1) % len(samples)
+        self.count += 1
+        if us > self.max_us:
+            self.max_us = us
+
+    def window(self):
+        # samples currently in the window
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def summary(self):
+        samples = sorted(self.window())
+        if not samples:
+            return None
+        return {
+            'count': self.count,
+            'mean_us': sum(samples)//len(samples),
+            'p50_us': samples[len(samples)//2],
+            'p90_us': samples[(len(samples)*9)//10],
+            'max_us': samples[-1],
+            'max_ever_us': self.max_us,
+            # { upper bound in us : samples } of the non-empty bands
+            'bands': {1 << band: n for band, n in enumerate(self.bands) if n},
+        }
+
+def _band(us):
+    band = 0
+    while us and band < _NUM_BANDS - 1:
+        us >>= 1
+        band += 1
+    return band
+
+
+class Profiler:
+    def __init__(self, window=64):
+        self.enabled = False
+        self.window = window
+        self.sections = {}  # { name : Histogram }
+        self.counters = {}
+        self._marks = {}
+        self._last_alloc = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.sections.clear()
+        self.counters.clear()
+        self._marks.clear()
+
+    def _histogram(self, name):
+        hist = self.sections.get(name)
+        if hist is None:
+            hist = self.sections[name] = Histogram(self.window)
+        return hist
+
+    ## instrumentation
+
+    def start(self):
+        # returns a start time for stop(), or None if disabled
+        if self.enabled:
+            return time.ticks_us()
+        return None
+
+    def stop(self, name, start):
+        if start is not None:
+            self._histogram(name).add(time.ticks_diff(time.ticks_us(), start))
+
+    def mark(self, name):
+        # records the interval between successive marks of the same name
+        if not self.enabled:
+            return
+        now = time.ticks_us()
+        last = self._marks.get(name)
+        self._marks[name] = now
+        if last is not None:
+            self._histogram(name).add(time.ticks_diff(now, last))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def collect(self):
+        # timed gc.collect(), also notices collections that happened on their own
+        if not self.enabled:
+            gc.collect()
+            return
+        if gc.mem_alloc() < self._last_alloc:
+            self.count('gc_auto')
+        start = time.ticks_us()
+        gc.collect()
+        self.stop('gc', start)
+        self._last_alloc = gc.mem_alloc()
+
+    ## reporting
+
+    def report(self):
+        sections = {}
+        for name, hist in self.sections.items():
+            summary = hist.summary()
+            if summary is not None:
+                sections[name] = summary
+        result = {'sections': sections, 'counters': dict(self.counters)}
+        frame = sections.get('frame')
+        if frame is not None and frame['mean_us'] > 0:
+            result['fps'] = 1000000/frame['mean_us']
+        return result
+
+    def print_report(self):
+        report = self.report()
+        if 'fps' in report:
+            print(f"profile: {report['fps']:.2f} frames/s")
+        for name, summary in report['sections'].items():
+            print(
+                f"  {name:14s} n={summary['count']:<6d} mean {summary['mean_us']:>7d} us"
+                f"  p50 {summary['p50_us']:>7d}  p90 {summary['p90_us']:>7d}  max {summary['max_us']:>7d}"
+            )
+        for name, value in report['counters'].items():
+            print(f"  {name:14s} {value}")
+
+PROFILER = Profiler()
@@ -7,6 +7,7 @@ from uctypes import (
     INT8, UINT8,
     INT16, UINT16,
     BFUINT16,
+    ARRAY,
     BF_POS,
     BF_LEN,
     BIG_ENDIAN,
@@ -17,6 +18,15 @@ from uctypes import (
 def array_filled(typecode, length, fill=0):
     return array(typecode, (fill for i in range(length)))
 
+def word_array(buf, signed=False):
+    # view a buffer as an array of big-endian 16-bit words
+    # the view does not keep a reference to buf, so the caller must keep buf
+    # alive for as long as the view is used
+    layout = {
+        'words' : (ARRAY | 0, (INT16 if signed else UINT16) | (len(buf) // 2)),
+    }
+    return uc_struct(addressof(buf), layout, BIG_ENDIAN).words
+
 def twos_complement(bits, value):
     if value < 0:
         return value + (1 << bits)
@@ -27,18 +37,19 @@ def twos_complement(bits, value):
 FD_BYTE = object()
 FD_WORD = object()
 
-FieldDesc = namedtuple('FieldDesc', ('name', 'layout', 'signed_bits'))
+# shift, bits and signed locate the field in a big-endian word for StructProto.decode()
+FieldDesc = namedtuple('FieldDesc', ('name', 'layout', 'signed_bits', 'shift', 'bits', 'signed'))
 def field_desc(name, bits, pos=0, signed=False):
     if bits is FD_WORD:
         layout = 0 | (INT16 if signed else UINT16)
-        return FieldDesc(name, layout, None)
+        return FieldDesc(name, layout, None, 0, 16, signed)
     
     if bits is FD_BYTE:
         layout = pos | (INT8 if signed else UINT8)
-        return FieldDesc(name, layout, None)
+        return FieldDesc(name, layout, None, 8 * (1 - pos), 8, signed)
 
     layout = 0 | BFUINT16 | pos << BF_POS | bits << BF_LEN
-    return FieldDesc(name, layout, bits if signed else None)
+    return FieldDesc(name, layout, bits if signed else None, pos, bits, signed)
 
 
 class StructProto:
@@ -47,13 +58,30 @@ class StructProto:
     def __init__(self, fields):
         self.layout = {}
         self.signed = {}
+        self.decoders = {}  # { name : (shift, mask, sign bit) }
         for fld in fields:
             self.layout[fld.name] = fld.layout
             if fld.signed_bits is not None:
                 self.signed[fld.name] = fld.signed_bits
+            sign = 1 << (fld.bits - 1) if fld.signed else 0
+            self.decoders[fld.name] = (fld.shift, (1 << fld.bits) - 1, sign)
+
+    def decode(self, name, buf, out, start=0, step=1):
+        # decodes field name from every big-endian word in buf into
+        # out[start], out[start + step], ... without creating a Struct per word
+        shift, mask, sign = self.decoders[name]
+        idx = start
+        for offset in range(0, len(buf) - 1, 2):
+            value = ((buf[offset] << 8 | buf[offset + 1]) >> shift) & mask
+            if value & sign:
+                value -= sign << 1
+            out[idx] = value
+            idx += step
+        return out
 
 class Struct:
     def __init__(self, buf, proto):
+        self.buf = buf  # the struct only holds the address, keep buf alive
         self._signed = proto.signed
         self._struct = uc_struct(addressof(buf), proto.layout, BIG_ENDIAN)
 